@@ -0,0 +1,276 @@
+"""Benchmark login, the catalog, refreshes and downloads against local stand-ins.
+
+Drives the real FastAPI app in-process through httpx's ASGI transport. Postgres
+and MySQL are replaced by generated SQLite tables (see benchmarks.standins), so
+the export path from fetched rows to files on disk is the real one. Each
+refresh scenario runs in a fresh process to report its own peak RSS. From the
+api/ directory:
+
+    python -m benchmarks.api_suite --rows 10000,100000,1000000 --formats csv,parquet
+
+Results are printed as JSON, or written to --output.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+from benchmarks import standins
+from benchmarks.login_throughput import percentile
+
+import httpx
+
+from main import app
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def summarize(latencies, elapsed) -> dict:
+    return {
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "requestsPerSecond": len(latencies) / elapsed,
+        "p50Ms": percentile(latencies, 50) * 1000,
+        "p99Ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def drive(send, requests, concurrency) -> dict:
+    """Send requests with at most concurrency in flight, timing each one"""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed():
+        async with semaphore:
+            started = time.perf_counter()
+            response = await send()
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(requests)))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+CREDENTIALS = {
+    "username": standins.BENCHMARK_USER,
+    "password": standins.BENCHMARK_PASSWORD,
+}
+
+
+async def login(client) -> str:
+    response = await client.post("/login", json=CREDENTIALS)
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+def catalog_entry(filename, export_format) -> dict:
+    return {
+        "fileName": filename,
+        "updatedAt": "2000-01-01 00:00:00",
+        "db": "PG",
+        "role": "A",
+        "formats": [export_format],
+    }
+
+
+def client_for_app():
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None
+    )
+
+
+async def run_api(workdir, requests, concurrency) -> dict:
+    """Login throughput and catalog listing latency"""
+    standins.install_user()
+    database = standins.SQLiteDatabase(os.path.join(workdir, "source.sqlite3"), "")
+    catalog = [catalog_entry(f"file_{index}", "csv") for index in range(100)]
+    standins.install_database(database, os.path.join(workdir, "api"), catalog)
+
+    async with client_for_app() as client:
+        login_result = await drive(
+            lambda: client.post("/login", json=CREDENTIALS),
+            max(1, requests // 10),  # bcrypt bound, see login_throughput
+            concurrency,
+        )
+        headers = {"Authorization": f"Bearer {await login(client)}"}
+        files_result = await drive(
+            lambda: client.get("/api/files", headers=headers), requests, concurrency
+        )
+
+    return {
+        "scenario": "api",
+        "login": login_result,
+        "files": files_result,
+        "peakRssBytes": peak_rss_bytes(),
+    }
+
+
+async def run_export(workdir, rows, export_format, requests, concurrency) -> dict:
+    """Refresh a generated table through PUT /api/files, then download it.
+
+    While the refresh runs / and /api/files are polled, their latency shows
+    whether the export blocks the event loop.
+    """
+    filename = f"bench_{rows}_{export_format.replace('.', '_')}"
+    table = f"rows_{rows}"
+    data_path = os.path.join(workdir, filename)
+
+    standins.install_user()
+    database = standins.SQLiteDatabase(os.path.join(workdir, "source.sqlite3"), "")
+    database.tables[filename] = table
+    standins.install_database(
+        database, data_path, [catalog_entry(filename, export_format)]
+    )
+
+    async with client_for_app() as client:
+        headers = {"Authorization": f"Bearer {await login(client)}"}
+
+        probes = {"/": [], "/api/files": []}
+        refresh_done = asyncio.Event()
+
+        async def probe(path):
+            # Requests served by the same worker while the export runs
+            while not refresh_done.is_set():
+                started = time.perf_counter()
+                response = await client.get(path, headers=headers)
+                response.raise_for_status()
+                probes[path].append(time.perf_counter() - started)
+                await asyncio.sleep(0.01)
+
+        probe_tasks = [asyncio.create_task(probe(path)) for path in probes]
+        started = time.perf_counter()
+        response = await client.put(
+            "/api/files", json={"db": "PG", "filename": filename}, headers=headers
+        )
+        response.raise_for_status()
+        job = response.json()
+        while job["status"] in ("queued", "running"):
+            await asyncio.sleep(0.05)
+            job = (
+                await client.get(f"/api/jobs/{job['job_id']}", headers=headers)
+            ).json()
+        refresh_seconds = time.perf_counter() - started
+        refresh_done.set()
+        await asyncio.gather(*probe_tasks)
+        if job["status"] != "succeeded":
+            raise RuntimeError(f"Refresh of {filename} failed: {job['error']}")
+
+        files = {
+            name: os.path.getsize(os.path.join(data_path, name))
+            for name in sorted(os.listdir(data_path))
+            if name.startswith(filename)
+        }
+        download_result = await drive(
+            lambda: client.get(f"/api/download/{filename}", headers=headers),
+            requests,
+            concurrency,
+        )
+        post_download_result = await drive(
+            lambda: client.post(
+                "/api/download/", json={"filename": filename}, headers=headers
+            ),
+            requests,
+            concurrency,
+        )
+
+    return {
+        "scenario": "export",
+        "rows": rows,
+        "format": export_format,
+        "refreshSeconds": refresh_seconds,
+        "rowsPerSecond": rows / refresh_seconds,
+        "duringRefresh": {
+            path: summarize(latencies, refresh_seconds)
+            | {"maxMs": max(latencies) * 1000}
+            for path, latencies in probes.items()
+        },
+        "files": files,
+        "download": download_result,
+        "postDownload": post_download_result,
+        "peakRssBytes": peak_rss_bytes(),
+    }
+
+
+def run_scenario(name, *args) -> dict:
+    """Entry point of the scenario processes"""
+    scenarios = {"api": run_api, "export": run_export}
+    logging.getLogger().setLevel(logging.WARNING)
+    # The app prints progress, keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        return asyncio.run(scenarios[name](*args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", default="10000,100000,1000000")
+    parser.add_argument("--formats", default="csv,parquet")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "api-benchmarks"),
+        help="Generated tables are kept here and reused across runs",
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    rows_counts = [int(rows) for rows in args.rows.split(",")]
+    formats = [name.strip() for name in args.formats.split(",")]
+    os.makedirs(args.workdir, exist_ok=True)
+
+    database = standins.SQLiteDatabase(os.path.join(args.workdir, "source.sqlite3"), "")
+    for rows in rows_counts:
+        database.create_table(f"rows_{rows}", rows)
+
+    scenarios = [("api", args.workdir, args.requests, args.concurrency)]
+    for rows in rows_counts:
+        for export_format in formats:
+            scenarios.append(
+                (
+                    "export",
+                    args.workdir,
+                    rows,
+                    export_format,
+                    args.requests,
+                    args.concurrency,
+                )
+            )
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for scenario in scenarios:
+        # A fresh process per scenario so peak RSS is not carried over
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(executor.submit(run_scenario, *scenario).result())
+
+    report = {
+        "benchmark": "api_suite",
+        "python": platform.python_version(),
+        "cpuCount": os.cpu_count(),
+        "exportChunkSize": int(os.getenv("EXPORT_CHUNK_SIZE", 10000)),
+        "results": results,
+    }
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
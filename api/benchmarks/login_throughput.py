@@ -0,0 +1,98 @@
+"""Measure /login throughput and how responsive / stays during a login storm.
+
+Runs the real FastAPI app in-process through httpx's ASGI transport with the
+user lookup replaced by an in-memory user, so only bcrypt, JWT and request
+handling are measured. Needs httpx installed. From the api/ directory:
+
+    python -m benchmarks.login_throughput --requests 200 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from benchmarks import standins
+
+import httpx
+
+from main import app
+from utils.auth_utils import PASSWORD_WORKERS, BCRYPT_ROUNDS
+
+
+def percentile(samples, percent):
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(len(samples) * percent / 100))
+    return samples[index]
+
+
+async def run(requests, concurrency):
+    standins.install_user()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        login_latencies = []
+        probe_latencies = []
+        semaphore = asyncio.Semaphore(concurrency)
+        storm_done = asyncio.Event()
+
+        async def login():
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(
+                    "/login",
+                    json={
+                        "username": standins.BENCHMARK_USER,
+                        "password": standins.BENCHMARK_PASSWORD,
+                    },
+                )
+                response.raise_for_status()
+                login_latencies.append(time.perf_counter() - started)
+
+        async def probe():
+            while not storm_done.is_set():
+                started = time.perf_counter()
+                await client.get("/")
+                probe_latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(0.01)
+
+        probe_task = asyncio.create_task(probe())
+        started = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(requests)))
+        elapsed = time.perf_counter() - started
+        storm_done.set()
+        await probe_task
+
+    cores = min(PASSWORD_WORKERS, os.cpu_count() or 1)
+    return {
+        "benchmark": "login_throughput",
+        "requests": requests,
+        "concurrency": concurrency,
+        "bcryptRounds": BCRYPT_ROUNDS,
+        "passwordWorkers": PASSWORD_WORKERS,
+        "seconds": elapsed,
+        "requestsPerSecond": requests / elapsed,
+        "requestsPerSecondPerCore": requests / elapsed / cores,
+        "loginP50Ms": percentile(login_latencies, 50) * 1000,
+        "loginP99Ms": percentile(login_latencies, 99) * 1000,
+        "rootP50Ms": statistics.median(probe_latencies) * 1000,
+        "rootP99Ms": percentile(probe_latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.requests, args.concurrency))
+    print(json.dumps(result, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+"""The app wired to the stand-ins, for benchmarks running real server workers.
+
+Each worker imports this module instead of main, with BENCHMARK_WORKDIR
+holding source.sqlite3 and an api/file_metadata.json prepared beforehand.
+"""
+
+import os
+
+from benchmarks import standins
+from main import app
+
+WORKDIR = os.environ["BENCHMARK_WORKDIR"]
+
+standins.install_user()
+standins.install_database(
+    standins.SQLiteDatabase(os.path.join(WORKDIR, "source.sqlite3"), ""),
+    os.path.join(WORKDIR, "api"),
+)
+
+__all__ = ["app"]
@@ -0,0 +1,159 @@
+"""Local stand-ins for Postgres, MySQL and the users table used by the benchmarks.
+
+Importing this module fills in the environment the app needs at import time,
+so import it before main.
+"""
+
+from datetime import datetime, timedelta
+import asyncio
+import json
+import os
+import sqlite3
+
+for name, value in {
+    "DB_PORT": "5432",
+    "DB_PASSWORD": "benchmark",
+    "MYSQL_DB_PORT": "3306",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    "REFRESH_TOKEN_EXPIRE_MINUTES": "600",
+    "SECRET_KEY": "benchmark",
+    "ALGORITHM": "HS256",
+    # One process per scenario, no leases left behind by earlier runs
+    "COORDINATION_BACKEND": "local",
+    # Measure the endpoints themselves, not the rate limits in front of them
+    "RATE_LIMIT_LOGIN": "",
+    "RATE_LIMIT_DOWNLOAD": "",
+    "RATE_LIMIT_REFRESH": "",
+    "RATE_LIMIT_API": "",
+}.items():
+    os.environ.setdefault(name, value)
+
+from services.logic import ApiLogicInstance
+from services.metadata import MetadataStore
+from services.users import UserRepositoryInstance
+from utils.auth_utils import pwd_context
+from utils.export_formats import ExportWriter, EXPORT_CHUNK_SIZE
+import services.logic
+
+BENCHMARK_USER = "benchmark"
+BENCHMARK_PASSWORD = "benchmark"
+
+_EPOCH = datetime(2024, 1, 1)
+
+
+def generate_rows(count):
+    """Deterministic rows mixing the types the real views return"""
+    for index in range(count):
+        yield (
+            index,
+            f"station-{index % 9973}",
+            round(index * 0.37 % 10000, 2),
+            _EPOCH + timedelta(seconds=index),
+            None if index % 10 == 0 else f"line {index % 17}",
+        )
+
+
+class SQLiteDatabase:
+    """Implements the execute_query_path interface of the database connections.
+
+    Each catalog file maps to a generated SQLite table. Chunks are fetched and
+    encoded in worker threads through the same ExportWriter as the real
+    connections.
+    """
+
+    def __init__(self, database_path, data_path) -> None:
+        self.database_path = database_path
+        self.data_path = data_path
+        self.tables = {}
+
+    def create_table(self, table, rows) -> None:
+        """Create the table with that many rows unless it already exists"""
+        with sqlite3.connect(self.database_path) as connection:
+            exists = connection.execute(
+                "SELECT count(*) FROM sqlite_master WHERE name = ?", (table,)
+            ).fetchone()[0]
+            if exists:
+                return
+            connection.execute(
+                f"CREATE TABLE {table} (id INTEGER, name TEXT, amount REAL, "
+                "created_at TIMESTAMP, note TEXT)"
+            )
+            connection.executemany(
+                f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?)", generate_rows(rows)
+            )
+
+    async def initialize(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def get_pool_stats(self) -> dict:
+        return {"size": 0, "idle": 0, "inUse": 0}
+
+    async def execute_query_path(
+        self, filename, formats=None, incremental=None, limits=None
+    ):
+        connection = sqlite3.connect(
+            self.database_path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+        )
+        try:
+            cursor = connection.execute(f"SELECT * FROM {self.tables[filename]}")
+            columns = [desc[0] for desc in cursor.description]
+            async with ExportWriter(
+                self.data_path, filename, columns, formats, incremental, limits
+            ) as writer:
+                result = await asyncio.to_thread(cursor.fetchmany, EXPORT_CHUNK_SIZE)
+                while result:
+                    await writer.write(result)
+                    result = await asyncio.to_thread(
+                        cursor.fetchmany, EXPORT_CHUNK_SIZE
+                    )
+            return writer.result()
+        finally:
+            connection.close()
+
+
+def install_user(role="A"):
+    """Serve a single in-memory user instead of querying test.users"""
+    user = {
+        "id": 1,
+        "username": BENCHMARK_USER,
+        "hashed_password": pwd_context.hash(BENCHMARK_PASSWORD),
+        "role": role,
+    }
+
+    async def get_by_username(username):
+        return user if username == user["username"] else None
+
+    async def update_password(username, hashed_password):
+        user["hashed_password"] = hashed_password
+
+    async def get_role(username):
+        return user["role"] if username == user["username"] else None
+
+    UserRepositoryInstance.get_by_username = get_by_username
+    UserRepositoryInstance.update_password = update_password
+    UserRepositoryInstance.get_role = get_role
+    return user
+
+
+def install_database(database, data_path, catalog=None):
+    """Point the app at the stand-in database, data folder and catalog entries.
+
+    Without catalog entries the file_metadata.json already in data_path is used.
+    """
+    os.makedirs(data_path, exist_ok=True)
+    json_file_path = os.path.join(data_path, "file_metadata.json")
+    if catalog is not None:
+        with open(json_file_path, "w") as file:
+            json.dump(catalog, file, indent=4)
+
+    database.data_path = data_path
+    ApiLogicInstance.data_path = data_path
+    ApiLogicInstance.json_file_path = json_file_path
+    ApiLogicInstance.metadata = MetadataStore(json_file_path)
+    services.logic.pg_db_instance = database
+    services.logic.mysql_db_instance = database
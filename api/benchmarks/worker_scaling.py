@@ -0,0 +1,219 @@
+"""Measure how throughput scales with the number of server worker processes.
+
+Starts serve.py over the stand-ins (see benchmarks.standin_app) for each
+worker count and drives it over real HTTP from several client processes, so
+the client is not the bottleneck. GET /api/files measures JSON encoding and
+token checks, POST /login bcrypt. From the api/ directory:
+
+    python -m benchmarks.worker_scaling --workers 1,2,4 --requests 2000
+
+Results are printed as JSON, or written to --output. Throughput can only scale
+up to the number of cores, cpuCount is part of the report.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import standins
+from benchmarks.login_throughput import percentile
+
+import httpx
+
+API_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CREDENTIALS = {
+    "username": standins.BENCHMARK_USER,
+    "password": standins.BENCHMARK_PASSWORD,
+}
+
+
+def prepare_workdir(workdir, catalog_size) -> None:
+    catalog = [
+        {
+            "fileName": f"file_{index}",
+            "updatedAt": "2000-01-01 00:00:00",
+            "db": "PG",
+            "role": "A",
+            "formats": ["csv"],
+        }
+        for index in range(catalog_size)
+    ]
+    os.makedirs(os.path.join(workdir, "api"), exist_ok=True)
+    with open(os.path.join(workdir, "api", "file_metadata.json"), "w") as file:
+        json.dump(catalog, file, indent=4)
+
+
+def start_server(workers, port, workdir) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "API_APP": "benchmarks.standin_app:app",
+        "API_HOST": "127.0.0.1",
+        "API_PORT": str(port),
+        "API_WORKERS": str(workers),
+        "BENCHMARK_WORKDIR": workdir,
+    }
+    server = subprocess.Popen(
+        [sys.executable, "serve.py"],
+        cwd=API_DIRECTORY,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/").status_code == 200:
+                return server
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def stop_server(server) -> None:
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def drive_client(base_url, scenario, requests, concurrency, token) -> list:
+    """Entry point of the client processes, returns the request latencies"""
+
+    async def run():
+        latencies = []
+        semaphore = asyncio.Semaphore(concurrency)
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(
+            base_url=base_url, timeout=None, limits=limits
+        ) as client:
+
+            async def send():
+                if scenario == "login":
+                    return await client.post("/login", json=CREDENTIALS)
+                return await client.get(
+                    "/api/files", headers={"Authorization": f"Bearer {token}"}
+                )
+
+            async def timed():
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await send()
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+
+            await asyncio.gather(*(timed() for _ in range(requests)))
+        return latencies
+
+    return asyncio.run(run())
+
+
+def run_load(base_url, scenario, requests, concurrency, clients, token) -> dict:
+    with ProcessPoolExecutor(max_workers=clients) as executor:
+        started = time.perf_counter()
+        futures = [
+            executor.submit(
+                drive_client,
+                base_url,
+                scenario,
+                requests // clients,
+                max(1, concurrency // clients),
+                token,
+            )
+            for _ in range(clients)
+        ]
+        latencies = [latency for future in futures for latency in future.result()]
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "requestsPerSecond": len(latencies) / elapsed,
+        "p50Ms": percentile(latencies, 50) * 1000,
+        "p99Ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--catalog-size", type=int, default=500)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "api-worker-scaling"),
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    prepare_workdir(args.workdir, args.catalog_size)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    results = []
+    for workers in [int(count) for count in args.workers.split(",")]:
+        server = start_server(workers, args.port, args.workdir)
+        try:
+            response = httpx.post(f"{base_url}/login", json=CREDENTIALS, timeout=None)
+            response.raise_for_status()
+            token = response.json()["access_token"]
+
+            result = {"workers": workers}
+            for scenario, requests in (
+                ("files", args.requests),
+                ("login", max(args.clients, args.requests // 20)),  # bcrypt bound
+            ):
+                result[scenario] = run_load(
+                    base_url,
+                    scenario,
+                    requests,
+                    args.concurrency,
+                    args.clients,
+                    token,
+                )
+            results.append(result)
+        finally:
+            stop_server(server)
+
+    for result in results:
+        for scenario in ("files", "login"):
+            result[scenario]["speedup"] = (
+                result[scenario]["requestsPerSecond"]
+                / results[0][scenario]["requestsPerSecond"]
+            )
+
+    report = {
+        "benchmark": "worker_scaling",
+        "python": platform.python_version(),
+        "cpuCount": os.cpu_count(),
+        "catalogSize": args.catalog_size,
+        "results": results,
+    }
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
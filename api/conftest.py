@@ -0,0 +1,15 @@
+"""Settings the app reads at import time, so the tests run without a .env"""
+
+import os
+
+for name, value in {
+    "DB_PORT": "5432",
+    "MYSQL_DB_PORT": "3306",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    "REFRESH_TOKEN_EXPIRE_MINUTES": "600",
+    "SECRET_KEY": "test",
+    "ALGORITHM": "HS256",
+    # Leases and buckets stay in the test process
+    "COORDINATION_BACKEND": "local",
+}.items():
+    os.environ.setdefault(name, value)
@@ -1,15 +1,29 @@
 import asyncpg
-import pandas as pd
-from pandas import DataFrame
 import os
 import logging
 from dotenv import load_dotenv
-from utils.dataframe import DataFrameUtils
+from utils.export_formats import (
+    ExportWriter,
+    EXPORT_CHUNK_SIZE,
+    EXPORT_STAGE_SECONDS,
+)
+from utils.pool_stats import PoolStats
+from services.queries import QueryRegistryInstance
 
 logging.basicConfig(level=logging.INFO)
 
 load_dotenv()
 
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", 1))
+# Also caps how many refreshes run against this database at once
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", 5))
+# Seconds to wait for a free connection before giving up
+PG_POOL_ACQUIRE_TIMEOUT = float(os.getenv("PG_POOL_ACQUIRE_TIMEOUT", 30))
+# Prepared statements kept per connection, 0 (off) is safe behind PgBouncer in
+# transaction pooling mode where named statements don't survive a transaction.
+# Raise it, e.g. to 100, only when connecting to Postgres directly
+PG_STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", 0))
+
 
 class DatabaseConnection:
 
@@ -20,6 +34,7 @@ class DatabaseConnection:
         self.password = os.getenv("DB_PASSWORD")
         self.port = int(os.getenv("DB_PORT"))
         self._pool = None
+        self.pool_stats = PoolStats("PG")
         self.data_path = os.path.join(os.path.dirname(__file__), "../data")
 
     async def initialize(self) -> None:
@@ -31,67 +46,122 @@ class DatabaseConnection:
                     user=self.user,
                     password=self.password,
                     port=self.port,
-                    min_size=1,
-                    max_size=5,
-                    statement_cache_size=0,  # Disables statement caching
+                    min_size=PG_POOL_MIN_SIZE,
+                    max_size=PG_POOL_MAX_SIZE,
+                    statement_cache_size=PG_STATEMENT_CACHE_SIZE,
                 )
                 print("Connected to Postgresql database")
             except (Exception, asyncpg.PostgresError) as error:
                 print(f"Error connecting to PostgreSQL database: {error}")
                 raise error
 
-    async def execute_and_save_query(self, query, filename) -> None:
-        """Execute the given query and save the result to a CSV file"""
+    async def validate_queries(self, queries) -> None:
+        """Prepare each catalog query once so the server reports errors at startup"""
         await self.initialize()
+        async with self.acquire() as connection:
+            for query in queries:
+                try:
+                    await connection.prepare(query.text)
+                except asyncpg.PostgresError as error:
+                    logging.error(f"Query file {query.path} is invalid: {error}")
+
+    def acquire(self):
+        """Acquire a pooled connection, timed and counted in pool_stats"""
+        return self.pool_stats.track(
+            self._pool.acquire(timeout=PG_POOL_ACQUIRE_TIMEOUT)
+        )
 
-        async with self.pool.acquire() as connection:
-            try:
-                print("Executing query")
-                result = await connection.fetch(query)
-                if result:
-                    columns = list(result[0].keys())  # Get column names
-                    result_df = pd.DataFrame(result, columns=columns)
-
-                    # Save DataFrame to CSV file
-                    DataFrameUtils.save_to_csv(result_df, self.data_path, filename)
-                    logging.info(f"DataFrame saved to CSV file {self.data_path}")
-            except (Exception, asyncpg.PostgresError) as error:
-                print(f"Error executing query: {error}, Connection error")
-                raise error
-
-    async def execute_query_path(self, filename):
+    def get_pool_stats(self) -> dict:
+        stats = {
+            "minSize": PG_POOL_MIN_SIZE,
+            "maxSize": PG_POOL_MAX_SIZE,
+            "size": 0,
+            "idle": 0,
+        }
+        if self._pool is not None:
+            stats["size"] = self._pool.get_size()
+            stats["idle"] = self._pool.get_idle_size()
+        return {**stats, **self.pool_stats.to_dict()}
+
+    async def execute_query_path(
+        self, filename, formats=None, incremental=None, limits=None
+    ):
+        """Run the query file and export it, returns its rows, bytes and watermark.
+
+        With an incremental config holding a watermark only rows whose
+        watermark column is past it are fetched. Passing one of the limits
+        rolls the transaction back, which closes the cursor and frees the
+        connection for the pool.
+        """
         await self.initialize()
 
-        query_path = os.path.join(
-            os.path.dirname(__file__), f"../services/query/postgres/{filename}.sql"
-        )
-
-        if not os.path.exists(query_path):
+        catalog_query = await QueryRegistryInstance.get("PG", filename)
+        if catalog_query is None:
             raise FileNotFoundError("Query path does not exist")
 
-        with open(query_path, "r") as file:
-            query = file.read()
-
-        async with self._pool.acquire() as connection:
+        query = catalog_query.text
+        args = ()
+        if incremental and incremental.get("watermark") is not None:
+            column = incremental["column"].replace('"', '""')
+            query = (
+                f"SELECT * FROM ({query}) AS incremental "
+                f'WHERE "{column}" > $1 ORDER BY "{column}"'
+            )
+            args = (incremental["watermark"],)
+
+        async with self.acquire() as connection:
             try:
                 print("Executing query")
-                result = await connection.fetch(query)
-                if result:
-                    columns = list(result[0].keys())  # Get column names
-                    result_df = pd.DataFrame(result, columns=columns)
-
-                    # Save DataFrame to CSV file
-                    DataFrameUtils.save_to_csv(result_df, self.data_path, filename)
-                    logging.info(f"DataFrame saved to CSV file {self.data_path}")
+                return await self._stream_to_file(
+                    connection, query, filename, formats, incremental, args, limits
+                )
             except (Exception, asyncpg.PostgresError) as error:
                 print(f"Error executing query: {error}, Connection error")
                 raise error
 
+    async def _stream_to_file(
+        self,
+        connection,
+        query,
+        filename,
+        formats,
+        incremental=None,
+        args=(),
+        limits=None,
+    ):
+        """Fetch the query through a server-side cursor and export it in chunks"""
+        async with connection.transaction():
+            with EXPORT_STAGE_SECONDS.time(stage="query"):
+                cursor = await connection.cursor(query, *args)
+                result = await cursor.fetch(EXPORT_CHUNK_SIZE)
+            if not result:
+                watermark = incremental and incremental.get("watermark")
+                return {
+                    "rows": 0,
+                    "bytes": 0,
+                    "changed": False,
+                    "watermark": watermark,
+                }
+
+            columns = list(result[0].keys())  # Get column names
+            async with ExportWriter(
+                self.data_path, filename, columns, formats, incremental, limits
+            ) as writer:
+                while result:
+                    await writer.write(result)
+                    with EXPORT_STAGE_SECONDS.time(stage="fetch"):
+                        result = await cursor.fetch(EXPORT_CHUNK_SIZE)
+
+        logging.info(f"Query result saved to {self.data_path}")
+        return writer.result()
+
     async def close(self):
         """Close the database connection and cursor"""
         try:
             if self._pool:
                 await self._pool.close()
+                self._pool = None
+                print("Connection pool has been closed")
         except Exception as error:
             print(f"Error while closing the connection or cursor: {error}")
             raise error
@@ -1,17 +1,41 @@
 import aiomysql
-import pandas as pd
 import os
 import logging
 from dotenv import load_dotenv
-from utils.dataframe import DataFrameUtils
+from utils.export_formats import (
+    ExportLimitExceeded,
+    ExportWriter,
+    EXPORT_CHUNK_SIZE,
+    EXPORT_STAGE_SECONDS,
+)
+from utils.pool_stats import PoolStats
+from services.queries import QueryRegistryInstance
+from contextlib import asynccontextmanager
+import asyncio
 
 logging.basicConfig(level=logging.INFO)
 
 load_dotenv()
 
+MYSQL_POOL_MIN_SIZE = int(os.getenv("MYSQL_POOL_MIN_SIZE", 1))
+# Also caps how many refreshes run against this database at once
+MYSQL_POOL_MAX_SIZE = int(os.getenv("MYSQL_POOL_MAX_SIZE", 5))
+# Seconds to wait for a free connection before giving up
+MYSQL_POOL_ACQUIRE_TIMEOUT = float(os.getenv("MYSQL_POOL_ACQUIRE_TIMEOUT", 30))
+
+
+def _select_query(filename, column=None) -> str:
+    """Export query of the mv table, only rows past the watermark with a column"""
+    query = f"SELECT * FROM `mv`.`{filename}` "
+    if column is not None:
+        column = column.replace("`", "``")
+        query += f"WHERE `{column}` > %s ORDER BY `{column}`"
+    return query
+
 
 class MysqlDatabaseConnection:
     _pool = None
+    pool_stats = PoolStats("MY")
 
     def __init__(self) -> None:
         self.host = os.getenv("MYSQL_DB_HOST")
@@ -30,73 +54,153 @@ class MysqlDatabaseConnection:
                     user=self.user,
                     password=self.password,
                     port=self.port,
-                    minsize=1,  # Minimum number of connections in the pool
-                    maxsize=5,  # Maximum number of connections in the pool
+                    minsize=MYSQL_POOL_MIN_SIZE,
+                    maxsize=MYSQL_POOL_MAX_SIZE,
                 )
                 print("Connected to MYSQL database using connection pool")
             except (Exception, aiomysql.Error) as error:
                 print(f"Error connecting to MYSQL database: {error}")
                 raise error
 
-    async def execute_and_save_query(self, query, filename) -> None:
-        async with MysqlDatabaseConnection._pool_acquire() as connection:
-            async with connection.cursor() as cursor:
-                try:
-                    await cursor.execute(query)
-                    result = await cursor.fetchall()
-                    columns = [desc[0] for desc in cursor.description]
-                    result_df = pd.DataFrame(result, columns=columns)
-
-                    # Save DataFrame to CSV file
-                    DataFrameUtils.save_to_csv(result_df, self.data_path, filename)
-                    logging.info(f"DataFrame saved to CSV file {self.data_path}")
-                except (Exception, aiomysql.Error) as error:
-                    print(f"Error executing query: {error}, Connection error")
-                    raise error
-
-    async def execute_query_path(self, filename):
-        await self.initialize()
-
-        query_path = os.path.join(
-            os.path.dirname(__file__), f"../services/query/mysql/refresh_{filename}.sql"
+    @asynccontextmanager
+    async def _acquire_with_timeout(self):
+        connection = await asyncio.wait_for(
+            MysqlDatabaseConnection._pool.acquire(), MYSQL_POOL_ACQUIRE_TIMEOUT
         )
+        try:
+            yield connection
+        finally:
+            MysqlDatabaseConnection._pool.release(connection)
+
+    def acquire(self):
+        """Acquire a pooled connection, timed and counted in pool_stats"""
+        return self.pool_stats.track(self._acquire_with_timeout())
+
+    def get_pool_stats(self) -> dict:
+        stats = {
+            "minSize": MYSQL_POOL_MIN_SIZE,
+            "maxSize": MYSQL_POOL_MAX_SIZE,
+            "size": 0,
+            "idle": 0,
+        }
+        if MysqlDatabaseConnection._pool is not None:
+            stats["size"] = MysqlDatabaseConnection._pool.size
+            stats["idle"] = MysqlDatabaseConnection._pool.freesize
+        return {**stats, **self.pool_stats.to_dict()}
+
+    async def execute_query_path(
+        self, filename, formats=None, incremental=None, limits=None
+    ):
+        """Rebuild the mv table and export it, returns its rows, bytes and watermark.
+
+        With an incremental config holding a watermark, only rows past the
+        watermark are exported. The refresh_incremental_<filename>.sql script
+        runs instead of the full rebuild when there is one.
+        """
+        await self.initialize()
 
-        if not os.path.exists(query_path):
-            raise error("Query path does not exist")
-
-        with open(query_path, "r") as file:
-            query = file.read()
-
-        async with self._pool.acquire() as connection:
+        delta = bool(incremental) and incremental.get("watermark") is not None
+        catalog_query = None
+        if delta:
+            catalog_query = await QueryRegistryInstance.get(
+                "MY", f"refresh_incremental_{filename}"
+            )
+            if catalog_query is None:
+                logging.warning(
+                    f"No refresh_incremental_{filename}.sql, rebuilding the whole "
+                    "mv table before exporting the new rows"
+                )
+        if catalog_query is None:
+            catalog_query = await QueryRegistryInstance.get("MY", f"refresh_{filename}")
+        if catalog_query is None:
+            raise FileNotFoundError("Query path does not exist")
+        query = catalog_query.text
+
+        args = None
+        column = None
+        if delta:
+            column = incremental["column"]
+            args = (incremental["watermark"],)
+        select_query = _select_query(filename, column)
+
+        async with self.acquire() as connection:
             async with connection.cursor() as cursor:
                 try:
                     print("running query")
-                    await cursor.execute(query)
-
-                    # Fetch the result of the SELECT query
-                    result = await cursor.fetchall()
-
-                    # Fetch column names from the query result
-                    await cursor.execute(f"SELECT * FROM `mv`.`{filename}` ")
-                    result2 = await cursor.fetchall()
-                    columns = [desc[0] for desc in cursor.description]
-                    result_df = pd.DataFrame(result2, columns=columns)
-
-                    # Save DataFrame to CSV file
-                    DataFrameUtils.save_to_csv(result_df, self.data_path, filename)
-                    logging.info(f"DataFrame saved to CSV file {self.data_path}")
+                    with EXPORT_STAGE_SECONDS.time(stage="query"):
+                        await cursor.execute(query)
+                        # Read past the results of a multi-statement script
+                        while await cursor.nextset():
+                            pass
+
+                    export = await self._stream_to_file(
+                        connection,
+                        select_query,
+                        filename,
+                        formats,
+                        incremental,
+                        args,
+                        limits,
+                    )
 
                     await connection.commit()
+                    return export
                 except (Exception, aiomysql.Error) as error:
-                    await connection.rollback()
+                    if not connection.closed:
+                        await connection.rollback()
                     print(f"Error executing query: {error}, Connection error")
                     raise error
 
+    async def _stream_to_file(
+        self,
+        connection,
+        query,
+        filename,
+        formats,
+        incremental=None,
+        args=None,
+        limits=None,
+    ):
+        """Fetch the query through an unbuffered cursor and export it in chunks"""
+        delta = bool(incremental) and incremental.get("watermark") is not None
+        cursor = await connection.cursor(aiomysql.SSCursor)
+        try:
+            with EXPORT_STAGE_SECONDS.time(stage="query"):
+                await cursor.execute(query, args)
+            columns = [desc[0] for desc in cursor.description]
+
+            async with ExportWriter(
+                self.data_path, filename, columns, formats, incremental, limits
+            ) as writer:
+                with EXPORT_STAGE_SECONDS.time(stage="fetch"):
+                    result = await cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                if result or not delta:
+                    # Always write the header, even without rows
+                    await writer.write(result)
+                while result:
+                    with EXPORT_STAGE_SECONDS.time(stage="fetch"):
+                        result = await cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                    if result:
+                        await writer.write(result)
+        except ExportLimitExceeded:
+            # MySQL keeps sending an unbuffered result until its end, closing
+            # the cursor would read every remaining row. Dropping the
+            # connection stops it, the pool discards closed connections.
+            connection.close()
+            raise
+        finally:
+            if not connection.closed:
+                await cursor.close()
+
+        logging.info(f"Query result saved to {self.data_path}")
+        return writer.result()
+
     async def close(self):
         try:
             if self._pool:
                 self._pool.close()
                 await self._pool.wait_closed()
+                MysqlDatabaseConnection._pool = None
                 print("Connection pool has been closed")
         except Exception as error:
             print(f"Error while closing the connection or cursor: {error}")
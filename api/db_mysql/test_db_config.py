@@ -0,0 +1,70 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from db_mysql.db_config import MysqlDatabaseConnection
+from services.queries import QueryRegistryInstance, QUERY_DIRECTORIES
+
+
+class Cursor:
+    def __init__(self, executed) -> None:
+        self.executed = executed
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, query, args=None):
+        self.executed.append(query)
+
+    async def nextset(self):
+        return None
+
+
+class Connection:
+    closed = False
+
+    def __init__(self) -> None:
+        self.executed = []
+
+    def cursor(self):
+        return Cursor(self.executed)
+
+    async def commit(self):
+        pass
+
+
+def test_incremental_refresh_without_its_script_rebuilds_the_table(
+    tmp_path, monkeypatch
+):
+    query_path = tmp_path / QUERY_DIRECTORIES["MY"]
+    query_path.mkdir()
+    (query_path / "refresh_stations.sql").write_text("REBUILD stations")
+    monkeypatch.setattr(QueryRegistryInstance, "root", str(tmp_path))
+
+    database = MysqlDatabaseConnection()
+    connection = Connection()
+    exported = []
+
+    async def initialize():
+        pass
+
+    @asynccontextmanager
+    async def acquire():
+        yield connection
+
+    async def stream_to_file(connection, query, filename, *args):
+        exported.append((query, args[-2]))
+
+    monkeypatch.setattr(database, "initialize", initialize)
+    monkeypatch.setattr(database, "acquire", acquire)
+    monkeypatch.setattr(database, "_stream_to_file", stream_to_file)
+
+    incremental = {"column": "id", "watermark": 7}
+    asyncio.run(database.execute_query_path("stations", ["csv"], incremental))
+
+    assert connection.executed == ["REBUILD stations"]
+    assert exported == [
+        ("SELECT * FROM `mv`.`stations` WHERE `id` > %s ORDER BY `id`", (7,))
+    ]
@@ -1,24 +1,90 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Request, status
 from services.routes import router as api_router
-from fastapi.responses import JSONResponse
+from websocket.routes import router as events_router
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from models import User, UserCreate, UserLogin, UserResponse, TokenRefreshRequest
-from jose import JWTError, jwt
+from models import (
+    UserCreate,
+    UserLogin,
+    UserResponse,
+    TokenRefreshRequest,
+    LogoutRequest,
+)
+from jose import JWTError
 import uvicorn
 import logging
 from utils.auth_utils import (
-    hash_password,
-    verify_password,
+    hash_password_async,
+    verify_and_update_password,
     create_access_token,
     create_refresh_token,
+    decode_token,
+    revoke_token,
+    sync_revocations,
     verify_token,
-    SECRET_KEY,
-    ALGORITHM,
+    verify_token_payload,
+)
+from services.users import UserRepositoryInstance
+from utils.rate_limit import rate_limit_by_client
+import asyncpg
+from services.scheduler import RefreshSchedulerInstance
+from db.db_config import pg_db_instance
+from db_mysql.db_config import mysql_db_instance
+from contextlib import asynccontextmanager
+from services.queries import QueryRegistryInstance
+from services.logic import ApiLogicInstance
+from websocket.events import EventBrokerInstance
+from utils.blocking_io import run_catalog_io
+from utils.metrics import metrics
+import asyncio
+import os
+import time
+
+# Seconds a stopping worker waits for its refresh jobs before cancelling them
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", 300))
+
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "http_request_seconds",
+    "Time to the response headers per route",
+    ["method", "route", "status"],
 )
-from database import get_db
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the pools before the first request instead of inside it
+    for db_instance in (pg_db_instance, mysql_db_instance):
+        try:
+            await db_instance.initialize()
+        except Exception:
+            logging.warning("Pool not pre-warmed, it will connect on first use")
+
+    # Read and check the catalog queries once, later refreshes reuse them
+    await run_catalog_io(QueryRegistryInstance.load)
+    try:
+        await pg_db_instance.validate_queries(QueryRegistryInstance.queries("PG"))
+    except Exception:
+        logging.warning("Postgres queries not validated, database unavailable")
+
+    RefreshSchedulerInstance.start()
+    revocations = asyncio.create_task(sync_revocations())
+    events = asyncio.create_task(EventBrokerInstance.relay())
+    yield
+    events.cancel()
+    revocations.cancel()
+    await RefreshSchedulerInstance.stop()
+
+    # Let running exports finish before their pools close under them
+    await ApiLogicInstance.refresh_jobs.drain(SHUTDOWN_DRAIN_SECONDS)
+
+    for db_instance in (pg_db_instance, mysql_db_instance):
+        try:
+            await db_instance.close()
+        except Exception:
+            logging.warning("Pool did not close cleanly")
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 origin = ["http://localhost:8080", "http://localhost:5173"]
@@ -32,14 +98,36 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # The route template keeps the label set small, /download/{filename}
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        method=request.method,
+        route=route.path if route is not None else "unmatched",
+        status=response.status_code,
+    )
+    return response
+
+
 logging.basicConfig(level=logging.INFO)
 app.include_router(api_router, prefix="/api", tags=["api"])
+app.include_router(events_router, prefix="/api", tags=["events"])
 
 
 ##include business router
 app.include_router(api_router)
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    """Metrics of this worker in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 # Protected route that requires a valid access token
 @app.get("/protected")
 def read_protected_data(current_user: str = Depends(verify_token)):
@@ -52,38 +140,56 @@ def testing():
 
 
 # register route
-@app.post("/users/", response_model=UserResponse)
-def create_user_route(user: UserCreate, db: Session = Depends(get_db)):
+@app.post(
+    "/users/",
+    response_model=UserResponse,
+    dependencies=[Depends(rate_limit_by_client("login"))],
+)
+async def create_user_route(user: UserCreate):
 
-    check_user = db.query(User).filter(User.username == user.username).first()
+    check_user = await UserRepositoryInstance.get_by_username(user.username)
 
     if check_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists"
         )
 
-    hashed_password = hash_password(user.password)
-    db_user = User(username=user.username, hashed_password=hashed_password)
+    hashed_password = await hash_password_async(user.password)
+    try:
+        db_user = await UserRepositoryInstance.create(user.username, hashed_password)
+    except asyncpg.UniqueViolationError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists"
+        )
 
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
     return JSONResponse(
-        content={"message": "User has been created", "username": db_user.username},
+        content={"message": "User has been created", "username": db_user["username"]},
         status_code=status.HTTP_201_CREATED,
     )
 
 
 # login (get tokens)
-@app.post("/login")
-def login_for_access_token(user: UserLogin, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == user.username).first()
-    if not db_user or not verify_password(user.password, db_user.hashed_password):
+@app.post("/login", dependencies=[Depends(rate_limit_by_client("login"))])
+async def login_for_access_token(user: UserLogin):
+    db_user = await UserRepositoryInstance.get_by_username(user.username)
+    if not db_user:
         raise HTTPException(status_code=401, detail="Invalid username or password")
 
-    # Generate access and refresh tokens
-    access_token = create_access_token(data={"sub": db_user.username})
-    refresh_token = create_refresh_token(data={"sub": db_user.username})
+    valid, new_hash = await verify_and_update_password(
+        user.password, db_user["hashed_password"]
+    )
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid username or password")
+
+    # Stored hash uses fewer than BCRYPT_ROUNDS, replace it while we have the password
+    if new_hash:
+        await UserRepositoryInstance.update_password(db_user["username"], new_hash)
+
+    # Generate access and refresh tokens, the role saves a lookup per request
+    access_token = create_access_token(
+        data={"sub": db_user["username"], "role": db_user["role"]}
+    )
+    refresh_token = create_refresh_token(data={"sub": db_user["username"]})
 
     return {
         "access_token": access_token,
@@ -92,28 +198,56 @@ def login_for_access_token(user: UserLogin, db: Session = Depends(get_db)):
     }
 
 
-@app.post("/token/refresh")
-def refresh_access_token(token_refresh_request: TokenRefreshRequest):
+@app.post("/token/refresh", dependencies=[Depends(rate_limit_by_client("login"))])
+async def refresh_access_token(token_refresh_request: TokenRefreshRequest):
     refresh_token = token_refresh_request.refresh_token
     try:
         # Decode the refresh token
-        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(refresh_token)
         username: str = payload.get("sub")
 
+        if payload.get("token_type") != "refresh_token":
+            raise HTTPException(status_code=401, detail="Refresh token required")
+
         # If username is missing, raise an exception
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid token")
 
-        # Create a new access token using the username from the refresh token
-        access_token = create_access_token(data={"sub": username})
-        return {"access_token": access_token, "token_type": "bearer"}
-
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
 
+    # Create a new access token using the username from the refresh token,
+    # with the current role so role changes apply on the next refresh
+    role = await UserRepositoryInstance.get_role(username)
+    if role is None:
+        raise HTTPException(status_code=401, detail="User not found")
+
+    access_token = create_access_token(data={"sub": username, "role": role})
+    return {"access_token": access_token, "token_type": "bearer"}
+
+
+@app.post("/logout")
+def logout(
+    logout_request: LogoutRequest = None,
+    payload: dict = Depends(verify_token_payload),
+):
+    """Revoke the access token, and the refresh token when one is sent"""
+    revoke_token(payload)
+    if logout_request and logout_request.refresh_token:
+        try:
+            refresh_payload = decode_token(logout_request.refresh_token)
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Invalid refresh token")
+        if refresh_payload.get("sub") == payload["sub"]:
+            revoke_token(refresh_payload)
+
+    return {"message": "Logged out"}
+
 
 # Run the app
 if __name__ == "__main__":
-    import uvicorn
+    import serve
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Metadata writes are lock protected, so several workers can share data/.
+    # A single worker serves this app, main.py is not imported a second time
+    serve.main(app=app)
@@ -0,0 +1,77 @@
+"""Run the API with one or more worker processes sharing a listening socket.
+
+The socket is bound once here and handed to every worker, the kernel spreads
+connections between them. Workers are started with the spawn method and import
+the app themselves, so database pools, executors and the coordination
+connection are all created per worker after it starts, in the app lifespan.
+Each worker opens up to PG_POOL_MAX_SIZE and MYSQL_POOL_MAX_SIZE connections,
+size the database connection limits for API_WORKERS times that.
+
+On SIGTERM or SIGINT every worker stops accepting connections, waits up to
+API_GRACEFUL_TIMEOUT seconds for open requests, then up to
+SHUTDOWN_DRAIN_SECONDS for its refresh jobs, and closes its pools last. With
+API_MAX_REQUESTS set a worker is replaced after serving about that many
+requests, API_MAX_REQUESTS_JITTER spreads the restarts so workers don't all
+recycle at once. SIGHUP restarts every worker, SIGTTIN and SIGTTOU add or
+remove one. The supervisor stops and joins workers one at a time, so a SIGHUP
+can take up to API_GRACEFUL_TIMEOUT + SHUTDOWN_DRAIN_SECONDS per worker (330 s
+with the defaults) while refreshes finish. Lower SHUTDOWN_DRAIN_SECONDS where
+restarts must be quick. From the api/ directory:
+
+    API_WORKERS=4 python serve.py
+"""
+
+import functools
+import logging
+import os
+import random
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+API_APP = os.getenv("API_APP", "main:app")
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+API_PORT = int(os.getenv("API_PORT", 8000))
+API_WORKERS = int(os.getenv("API_WORKERS", 1))
+# Requests served before a worker is replaced, 0 never recycles workers
+API_MAX_REQUESTS = int(os.getenv("API_MAX_REQUESTS", 0))
+API_MAX_REQUESTS_JITTER = int(os.getenv("API_MAX_REQUESTS_JITTER", 0))
+# Seconds a stopping worker waits for open connections to finish
+API_GRACEFUL_TIMEOUT = float(os.getenv("API_GRACEFUL_TIMEOUT", 30))
+
+
+def run_worker(config, sockets=None) -> None:
+    """Entry point of the worker processes"""
+    if config.limit_max_requests:
+        config.limit_max_requests += random.randint(0, API_MAX_REQUESTS_JITTER)
+    uvicorn.Server(config).run(sockets=sockets)
+
+
+def main(app=API_APP, host=API_HOST, port=API_PORT, workers=API_WORKERS) -> None:
+    """Serve app, an import string or, with a single worker, the app object"""
+    single = workers == 1 and not API_MAX_REQUESTS
+    if not single and not isinstance(app, str):
+        # Spawned workers import the app by name
+        app = API_APP
+    config = uvicorn.Config(
+        app,
+        host=host,
+        port=port,
+        workers=workers,
+        limit_max_requests=API_MAX_REQUESTS or None,
+        timeout_graceful_shutdown=API_GRACEFUL_TIMEOUT,
+    )
+    if single:
+        uvicorn.Server(config).run()
+        return
+
+    # The supervisor restarts workers that exit, recycled ones included
+    logging.info(f"Starting {workers} workers on {host}:{port}")
+    sock = config.bind_socket()
+    Multiprocess(
+        config, target=functools.partial(run_worker, config), sockets=[sock]
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
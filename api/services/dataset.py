@@ -0,0 +1,215 @@
+from fastapi import HTTPException
+from typing import Dict, List
+from utils.export_store import ExportStoreInstance
+import base64
+import json
+import os
+import tempfile
+import threading
+
+# Rows returned per page unless the client asks for fewer
+DATA_PAGE_SIZE = int(os.getenv("DATA_PAGE_SIZE", 100))
+DATA_MAX_PAGE_SIZE = int(os.getenv("DATA_MAX_PAGE_SIZE", 10000))
+
+FILTER_OPERATORS = ("eq", "ne", "lt", "le", "gt", "ge")
+
+
+class DatasetStore:
+    """Query exports through memory-mapped Arrow IPC copies.
+
+    The arrow export is used when it is at least as new as the CSV, otherwise
+    the CSV is converted once into data/.arrow/<name>.<version>.arrow. Mapped tables are
+    kept open until the file they were read from changes.
+    """
+
+    def __init__(self, data_path) -> None:
+        self.data_path = data_path
+        self.cache_path = os.path.join(data_path, ".arrow")
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _arrow_path(self, filename):
+        """Arrow file to read and the export version it holds"""
+        csv_path = os.path.join(self.data_path, filename + ".csv")
+        export_path = os.path.join(self.data_path, filename + ".arrow")
+
+        if not os.path.exists(csv_path):
+            if os.path.exists(export_path):
+                return export_path, ExportStoreInstance.modified_ns(export_path)
+            raise HTTPException(status_code=404, detail=f"File not found {filename}")
+
+        csv_version = ExportStoreInstance.modified_ns(csv_path)
+        if os.path.exists(export_path):
+            export_version = ExportStoreInstance.modified_ns(export_path)
+            if export_version >= csv_version:
+                return export_path, export_version
+
+        # Keyed on the CSV version, blobs shared between names keep their mtime
+        cache_path = os.path.join(self.cache_path, f"{filename}.{csv_version}.arrow")
+        if not os.path.exists(cache_path):
+            self._convert(csv_path, cache_path)
+            self._remove_stale(filename, cache_path)
+        return cache_path, csv_version
+
+    def _remove_stale(self, filename, cache_path) -> None:
+        """Delete older conversions of filename, cache_path is kept"""
+        for entry in os.listdir(self.cache_path):
+            if not entry.endswith(".arrow"):
+                continue
+            stem = entry[: -len(".arrow")]
+            name, _, version = stem.rpartition(".")
+            path = os.path.join(self.cache_path, entry)
+            if path != cache_path and (
+                stem == filename or (name == filename and version.isdigit())
+            ):
+                os.remove(path)
+
+    def _convert(self, csv_path, arrow_path) -> None:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+
+        os.makedirs(os.path.dirname(arrow_path), exist_ok=True)
+        table = pa_csv.read_csv(csv_path)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(arrow_path), suffix=".tmp")
+        os.close(fd)
+        try:
+            with pa.ipc.new_file(tmp_path, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(tmp_path, arrow_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get_table(self, filename):
+        """Memory-mapped table and the version of the export behind it"""
+        import pyarrow as pa
+
+        # Queries run on worker threads, only one of them converts a file
+        with self._lock:
+            path, version = self._arrow_path(filename)
+            cached = self._tables.get(filename)
+            if cached is not None and cached[0] == (path, version):
+                return cached[1], version
+
+            with pa.memory_map(path) as source:
+                table = pa.ipc.open_file(source).read_all()
+            self._tables[filename] = ((path, version), table)
+            return table, version
+
+    def query(
+        self,
+        filename,
+        columns: List[str] = None,
+        filters: List[str] = None,
+        sort: List[str] = None,
+        limit: int = None,
+        cursor: str = None,
+    ) -> Dict:
+        """Project, filter, sort and page through an export.
+
+        Filters are "column:op:value" with op one of eq, ne, lt, le, gt, ge.
+        Sort keys are column names, prefixed with "-" for descending. The
+        cursor returned with a page fetches the next one and is rejected if the
+        export was refreshed in between.
+        """
+        if limit is not None and limit < 1:
+            raise HTTPException(status_code=400, detail="Limit must be 1 or more")
+        table, version = self.get_table(filename)
+        limit = min(limit or DATA_PAGE_SIZE, DATA_MAX_PAGE_SIZE)
+        offset = self._decode_cursor(cursor, version)
+
+        for column in (columns or []) + [key.lstrip("-") for key in sort or []]:
+            if column not in table.column_names:
+                raise HTTPException(status_code=400, detail=f"Unknown column {column}")
+
+        for condition in filters or []:
+            table = table.filter(self._filter_expression(table, condition))
+
+        if sort:
+            table = table.sort_by(
+                [
+                    (
+                        key.lstrip("-"),
+                        "descending" if key.startswith("-") else "ascending",
+                    )
+                    for key in sort
+                ]
+            )
+
+        page = table.slice(offset, limit)
+        if columns:
+            page = page.select(columns)
+
+        next_offset = offset + page.num_rows
+        return {
+            "columns": page.column_names,
+            "rows": page.to_pylist(),
+            "total": table.num_rows,
+            "nextCursor": (
+                self._encode_cursor(next_offset, version)
+                if next_offset < table.num_rows
+                else None
+            ),
+        }
+
+    def _filter_expression(self, table, condition):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        try:
+            column, operator, value = condition.split(":", 2)
+        except ValueError:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Filter must be column:op:value, got {condition}",
+            )
+        if column not in table.column_names:
+            raise HTTPException(status_code=400, detail=f"Unknown column {column}")
+        if operator not in FILTER_OPERATORS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown operator {operator}, expected one of {FILTER_OPERATORS}",
+            )
+
+        try:
+            scalar = pc.cast(pa.scalar(value), table.schema.field(column).type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            raise HTTPException(
+                status_code=400, detail=f"Invalid value {value} for column {column}"
+            )
+
+        field = pc.field(column)
+        return {
+            "eq": field == scalar,
+            "ne": field != scalar,
+            "lt": field < scalar,
+            "le": field <= scalar,
+            "gt": field > scalar,
+            "ge": field >= scalar,
+        }[operator]
+
+    @staticmethod
+    def _encode_cursor(offset, version) -> str:
+        raw = json.dumps({"offset": offset, "version": version}).encode()
+        return base64.urlsafe_b64encode(raw).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor, version) -> int:
+        if not cursor:
+            return 0
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            offset = int(position["offset"])
+        except (ValueError, KeyError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if offset < 0:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if position.get("version") != version:
+            raise HTTPException(
+                status_code=409, detail="Data was refreshed, restart pagination"
+            )
+        return offset
+
+
+DatasetStoreInstance = DatasetStore(os.path.join(os.path.dirname(__file__), "../data"))
@@ -0,0 +1,337 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict
+import asyncio
+import logging
+import os
+import uuid
+
+from fastapi import HTTPException
+from utils.blocking_io import run_coordination_io
+from utils.metrics import metrics
+
+logging.basicConfig(level=logging.INFO)
+
+# Finished jobs kept around for the status endpoint
+REFRESH_JOB_HISTORY = int(os.getenv("REFRESH_JOB_HISTORY", 500))
+# Seconds a refresh lease lasts unless renewed. The worker holding it renews it
+# every third of that while the job is queued or running, so a long refresh is
+# never started twice and a dead worker blocks the file for at most this long.
+REFRESH_LEASE_SECONDS = int(os.getenv("REFRESH_LEASE_SECONDS", 120))
+# How long job status stays visible to the other workers
+REFRESH_JOB_TTL_SECONDS = 24 * 60 * 60
+REMOTE_JOB_POLL_SECONDS = 1
+# Tries to take or find the lease of a file another worker is racing us for
+SUBMIT_ATTEMPTS = 3
+SUBMIT_RETRY_SECONDS = 0.05
+
+REFRESH_TOTAL = metrics.counter(
+    "refresh_jobs_total", "Finished refresh jobs", ["database", "status"]
+)
+REFRESH_QUEUED_SECONDS = metrics.histogram(
+    "refresh_queued_seconds",
+    "Time refresh jobs waited for a database slot",
+    ["database"],
+)
+REFRESH_SECONDS = metrics.histogram(
+    "refresh_seconds", "Refresh job run time", ["database"]
+)
+
+
+def _format_time(value):
+    return value.strftime("%Y-%m-%d %H:%M:%S") if value else None
+
+
+class RefreshJob:
+    def __init__(self, database, filename) -> None:
+        self.id = uuid.uuid4().hex
+        self.database = database
+        self.filename = filename
+        self.status = "queued"
+        self.error = None
+        self.submitted_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def to_dict(self) -> Dict:
+        duration = None
+        if self.started_at:
+            duration = (
+                (self.finished_at or datetime.now()) - self.started_at
+            ).total_seconds()
+
+        return {
+            "job_id": self.id,
+            "db": self.database,
+            "filename": self.filename,
+            "status": self.status,
+            "error": self.error,
+            "submittedAt": _format_time(self.submitted_at),
+            "startedAt": _format_time(self.started_at),
+            "finishedAt": _format_time(self.finished_at),
+            "durationSeconds": duration,
+        }
+
+
+def _pending_record(job_id, database, filename) -> Dict:
+    """Record of a job whose owner has not saved it yet"""
+    return {
+        "job_id": job_id,
+        "db": database,
+        "filename": filename,
+        "status": "queued",
+        "error": None,
+        "submittedAt": None,
+        "startedAt": None,
+        "finishedAt": None,
+        "durationSeconds": None,
+    }
+
+
+class RemoteRefreshJob:
+    """Status of a job run by another worker, as stored in the shared backend"""
+
+    def __init__(self, record) -> None:
+        self.record = record
+
+    @property
+    def id(self) -> str:
+        return self.record["job_id"]
+
+    @property
+    def filename(self) -> str:
+        return self.record["filename"]
+
+    @property
+    def status(self) -> str:
+        return self.record["status"]
+
+    @property
+    def error(self) -> str:
+        return self.record["error"]
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def to_dict(self) -> Dict:
+        return dict(self.record)
+
+
+class RefreshJobQueue:
+    """In-process queue of file refreshes.
+
+    Concurrent submissions for a file that is already queued or running are
+    coalesced into the existing job, so each refresh query runs once. Each
+    database gets its own concurrency limit, jobs beyond it stay queued.
+
+    A job holds the refresh:<filename> lease in the coordination backend from
+    submission until it finishes, and its status is mirrored there. Workers
+    that find the lease taken hand out the other worker's job instead. Backend
+    calls run on the coordination threads, so a busy SQLite file stalls the
+    request waiting on it and not the whole worker.
+    """
+
+    def __init__(self, run_refresh, concurrency: Dict[str, int], backend) -> None:
+        self._run_refresh = run_refresh
+        self._backend = backend
+        self._semaphores = {
+            database: asyncio.Semaphore(limit)
+            for database, limit in concurrency.items()
+        }
+        self._default_semaphore = asyncio.Semaphore(1)
+        self._jobs = OrderedDict()
+        self._inflight = {}
+        # Files whose refresh is being admitted by check, set once it's decided
+        self._admitting = {}
+
+    def inflight_count(self, database=None) -> int:
+        """Jobs queued or running in this worker, for one database or all"""
+        if database is None:
+            return len(self._inflight)
+        return sum(1 for job in self._inflight.values() if job.database == database)
+
+    async def submit(self, database, filename, check=None):
+        """Queue a refresh, or return the job already refreshing this file.
+
+        check(filename) is awaited once the lease is held and may raise to
+        refuse the refresh, e.g. while the file is in its cooldown window.
+        """
+        lease = f"refresh:{filename}"
+        attempts = 0
+        while True:
+            job = self._inflight.get(filename)
+            if job is not None:
+                return job
+
+            admitting = self._admitting.get(filename)
+            if admitting is not None:
+                # This worker holds the lease and is still checking, wait for it
+                await admitting.wait()
+                continue
+
+            owner = await run_coordination_io(self._backend.owner, lease)
+            if owner is not None:
+                # The owner saves its job record just after taking the lease
+                return await self.get(owner) or RemoteRefreshJob(
+                    _pending_record(owner, database, filename)
+                )
+
+            job = RefreshJob(database, filename)
+            if await run_coordination_io(
+                self._backend.acquire, lease, job.id, REFRESH_LEASE_SECONDS
+            ):
+                break
+            attempts += 1
+            if attempts >= SUBMIT_ATTEMPTS:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Refresh of {filename} is being started elsewhere, "
+                    "try again",
+                )
+            # Another worker took the lease since we looked, look again
+            await asyncio.sleep(SUBMIT_RETRY_SECONDS)
+
+        if check is not None:
+            admitting = self._admitting[filename] = asyncio.Event()
+            try:
+                await check(filename)
+            except BaseException:
+                await run_coordination_io(self._backend.release, lease, job.id)
+                raise
+            finally:
+                del self._admitting[filename]
+                admitting.set()
+
+        self._inflight[filename] = job
+        self._jobs[job.id] = job
+        self._trim_history()
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    async def get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+
+        record = await run_coordination_io(self._backend.get, f"job:{job_id}")
+        return RemoteRefreshJob(record) if record else None
+
+    async def wait(self, job):
+        """Wait for the job to finish without cancelling it if the caller is"""
+        if isinstance(job, RefreshJob):
+            await asyncio.shield(job.task)
+            return job
+
+        while not job.done:
+            await asyncio.sleep(REMOTE_JOB_POLL_SECONDS)
+            # Check the lease before the record, the owner saves the final
+            # status before it releases the lease
+            owner = await run_coordination_io(
+                self._backend.owner, f"refresh:{job.filename}"
+            )
+            job = await self.get(job.id) or job
+            held = owner == job.id
+            if not job.done and not held:
+                # The worker running it went away before recording the result
+                job.record.update(status="failed", error="Refresh was interrupted")
+        return job
+
+    async def _save(self, job) -> None:
+        await run_coordination_io(
+            self._backend.set,
+            f"job:{job.id}",
+            job.to_dict(),
+            ttl=REFRESH_JOB_TTL_SECONDS,
+        )
+
+    async def _run(self, job) -> None:
+        renewal = asyncio.create_task(self._renew_lease(job))
+        try:
+            await self._save(job)
+            semaphore = self._semaphores.get(job.database, self._default_semaphore)
+            async with semaphore:
+                await self._execute(job)
+        except asyncio.CancelledError:
+            if not job.done:
+                job.status = "failed"
+                job.error = "Refresh was interrupted"
+            raise
+        finally:
+            renewal.cancel()
+            self._inflight.pop(job.filename, None)
+            await self._save(job)
+            await run_coordination_io(
+                self._backend.release, f"refresh:{job.filename}", job.id
+            )
+
+    async def _execute(self, job) -> None:
+        job.status = "running"
+        job.started_at = datetime.now()
+        REFRESH_QUEUED_SECONDS.observe(
+            (job.started_at - job.submitted_at).total_seconds(),
+            database=job.database,
+        )
+        await self._save(job)
+        logging.info(f"Refresh job {job.id} started for {job.filename}")
+        try:
+            await self._run_refresh(job.database, job.filename)
+            job.status = "succeeded"
+        except Exception as error:
+            logging.error(f"Refresh job {job.id} failed: {error}")
+            job.status = "failed"
+            job.error = str(error)
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.error = "Refresh was interrupted"
+            raise
+        finally:
+            job.finished_at = datetime.now()
+            REFRESH_TOTAL.inc(database=job.database, status=job.status)
+            REFRESH_SECONDS.observe(
+                (job.finished_at - job.started_at).total_seconds(),
+                database=job.database,
+            )
+
+    async def _renew_lease(self, job) -> None:
+        while True:
+            await asyncio.sleep(REFRESH_LEASE_SECONDS / 3)
+            if not await run_coordination_io(
+                self._backend.acquire,
+                f"refresh:{job.filename}",
+                job.id,
+                REFRESH_LEASE_SECONDS,
+            ):
+                logging.warning(
+                    f"Refresh job {job.id} lost the lease of {job.filename}"
+                )
+
+    async def drain(self, timeout) -> None:
+        """Wait for the jobs queued or running in this worker, cancelling any
+        still unfinished after timeout seconds so the worker can exit.
+        """
+        tasks = [job.task for job in self._inflight.values() if job.task is not None]
+        if not tasks:
+            return
+
+        logging.info(f"Waiting for {len(tasks)} refresh jobs to finish")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logging.warning(
+                f"Cancelling {len(pending)} refresh jobs still running after {timeout}s"
+            )
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+
+    def _trim_history(self) -> None:
+        while len(self._jobs) > REFRESH_JOB_HISTORY:
+            job_id, job = next(iter(self._jobs.items()))
+            if not job.done:
+                break
+            del self._jobs[job_id]
@@ -1,75 +1,132 @@
-from db.db_config import pg_db_instance
-from db_mysql.db_config import mysql_db_instance
+from db.db_config import pg_db_instance, PG_POOL_MAX_SIZE
+from db_mysql.db_config import mysql_db_instance, MYSQL_POOL_MAX_SIZE
 from fastapi import HTTPException
+from services.metadata import MetadataStore, load_watermark, dump_watermark
+from services.jobs import RefreshJob, RefreshJobQueue
+from websocket.events import EventBrokerInstance
+from utils.coordination import CoordinationBackendInstance
+from utils.metrics import metrics
+from utils.blocking_io import run_catalog_io, run_coordination_io, run_export_io
+from utils.export_store import ExportStoreInstance
+from utils.export_formats import (
+    DEFAULT_EXPORT_FORMATS,
+    get_export_format,
+    with_precompressed,
+)
 from typing import List, Dict
 import os
-import json
 from datetime import datetime, timedelta
+import asyncio
 import logging
+import time
 
 logging.basicConfig(level=logging.INFO)
 
+REFRESH_COOLDOWN = timedelta(minutes=3)
+# Refreshes queued or running per database in this worker before new ones get
+# a 429, so a burst of refreshes can't pile up waiting for pool connections
+REFRESH_MAX_PENDING = int(os.getenv("REFRESH_MAX_PENDING", 16))
+REFRESH_RETRY_AFTER_SECONDS = int(os.getenv("REFRESH_RETRY_AFTER_SECONDS", 30))
+# Refreshes slower than this many seconds are logged with their size, 0 disables
+SLOW_REFRESH_SECONDS = float(os.getenv("SLOW_REFRESH_SECONDS", 0))
+
+EXPORT_ROWS = metrics.counter("export_rows_total", "Rows exported", ["database"])
+EXPORT_BYTES = metrics.counter(
+    "export_bytes_total", "Bytes written by exports", ["database"]
+)
+
 
 class ApiLogic:
     def __init__(self):
         self.json_file_path = os.path.join(
             os.path.dirname(__file__), "../data/file_metadata.json"
         )
+        self.data_path = os.path.join(os.path.dirname(__file__), "../data")
+        self.metadata = MetadataStore(self.json_file_path)
+        self.last_downloaded = {}
+        self.coordination = CoordinationBackendInstance
+        self.refresh_jobs = RefreshJobQueue(
+            self._refresh,
+            {"PG": PG_POOL_MAX_SIZE, "MY": MYSQL_POOL_MAX_SIZE},
+            self.coordination,
+        )
 
     def get_filenames_details(self, role) -> List[Dict]:
-        if not os.path.exists(self.json_file_path):
+        if not self.metadata.exists():
             raise HTTPException(
                 status_code=404, detail=f"File not found, check the json path"
             )
 
-        with open(self.json_file_path, "r") as file:
-            details = json.load(file)
-
         if role == "admin":
-            return details
-        elif role == "A":
-            return [file for file in details if file["role"] == "A"]
-        elif role == "B":
-            return [file for file in details if file["role"] == "B"]
+            return self.metadata.all()
+        elif role in ("A", "B"):
+            return self.metadata.by_role(role)
         else:
             raise HTTPException(status_code=401, detail="Unauthorized user")
 
     def check_get_update(self, filename, method) -> datetime:
-        with open(self.json_file_path, "r") as file:
-            details = json.load(file)
-
         if method == "get_update":
+            file_detail = self.metadata.find(filename)
+            if file_detail is None:
+                return None
 
-            for file_detail in details:
-                if filename in file_detail["fileName"].lower():
-                    print(
-                        file_detail["fileName"],
-                        datetime.strptime(
-                            file_detail["updatedAt"], "%Y-%m-%d %H:%M:%S"
-                        ),
-                    )
-                    return datetime.strptime(
-                        file_detail["updatedAt"], "%Y-%m-%d %H:%M:%S"
-                    )
-            return None
+            updated_at = datetime.strptime(
+                file_detail["updatedAt"], "%Y-%m-%d %H:%M:%S"
+            )
+            print(file_detail["fileName"], updated_at)
+            return updated_at
         elif method == "put_update":
-            for file_detail in details:
-                if filename in file_detail["fileName"].lower():
-                    file_detail["updatedAt"] = datetime.now().strftime(
-                        "%Y-%m-%d %H:%M:%S"
-                    )
-                    break
+            self.metadata.update_entry(
+                filename, updatedAt=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            )
+            return None
 
-            # save file back into json file
-            with open(self.json_file_path, "w") as file:
-                json.dump(details, file, indent=4)
+    def get_file_detail(self, filename) -> Dict:
+        return self.metadata.find(filename)
 
-            return None
+    def get_export_formats(self, filename) -> List[str]:
+        """Formats configured for the file in the metadata, the first one is the default"""
+        file_detail = self.get_file_detail(filename)
+        if file_detail and file_detail.get("formats"):
+            return file_detail["formats"]
+        return DEFAULT_EXPORT_FORMATS
+
+    def record_download(self, filename) -> None:
+        """Remember when the file was last downloaded, see RefreshScheduler"""
+        self.last_downloaded[filename] = datetime.now()
+
+    async def submit_refresh(self, database, filename) -> RefreshJob:
+        """Queue a refresh of the file, joining one already queued or running"""
+        return await self.refresh_jobs.submit(
+            database,
+            filename,
+            check=lambda filename: self.check_refresh(database, filename),
+        )
+
+    async def check_refresh(self, database, filename) -> None:
+        """Admit a new refresh, joining a running one is always allowed"""
+        if self.refresh_jobs.inflight_count(database) >= REFRESH_MAX_PENDING:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many refreshes queued for {database}, try again later",
+                headers={"Retry-After": str(REFRESH_RETRY_AFTER_SECONDS)},
+            )
+        await self.check_refresh_cooldown(filename)
+
+    async def check_refresh_cooldown(self, filename) -> None:
+        """Refuse refreshes within REFRESH_COOLDOWN of the last one in any worker"""
+        last_updated = await run_coordination_io(
+            self.coordination.get, f"cooldown:{filename}"
+        )
+        if last_updated:
+            last_updated_time = datetime.fromisoformat(last_updated)
+        else:
+            last_updated_time = await run_catalog_io(
+                self.check_get_update, filename, "get_update"
+            )
 
-    async def update_file(self, database, filename) -> None:
-        last_updated_time = self.check_get_update(filename, "get_update")
         if last_updated_time and last_updated_time > (
-            datetime.now() - timedelta(minutes=3)
+            datetime.now() - REFRESH_COOLDOWN
         ):
             print("error updateding")
             raise HTTPException(
@@ -77,22 +134,278 @@ class ApiLogic:
                 detail=f"File {filename} was updated less than 3 minutes ago",
             )
 
+    async def update_file(self, database, filename) -> None:
+        """Refresh the file and wait for the refresh to finish"""
+        job = await self.refresh_jobs.wait(
+            await self.submit_refresh(database, filename)
+        )
+        if job.status == "failed":
+            raise HTTPException(
+                status_code=500, detail=f"Error executing query: {job.error}"
+            )
+
+    async def refresh_batch(self, filenames=None, role=None) -> Dict:
+        """Refresh several files concurrently and report how each one went.
+
+        Takes explicit file names or every file visible to a role. Refreshes
+        run through the job queue, so they are limited per database.
+        """
+        if filenames is None:
+            filenames = [
+                file_detail["fileName"]
+                for file_detail in await run_catalog_io(
+                    self.get_filenames_details, role
+                )
+            ]
+        filenames = [filename.lower() for filename in filenames]
+        file_details = await run_catalog_io(
+            lambda: [self.metadata.find(filename) for filename in filenames]
+        )
+
+        started = time.perf_counter()
+        results = []
+        jobs = []
+        for filename, file_detail in zip(filenames, file_details):
+            if file_detail is None:
+                results.append(
+                    {
+                        "filename": filename,
+                        "status": "failed",
+                        "error": "File not found",
+                    }
+                )
+                continue
+
+            try:
+                job = await self.submit_refresh(file_detail["db"], filename)
+            except HTTPException as error:
+                results.append(
+                    {"filename": filename, "status": "skipped", "error": error.detail}
+                )
+                continue
+
+            jobs.append(job)
+            results.append(None)  # filled in once the job finishes
+
+        finished = iter(
+            await asyncio.gather(*(self.refresh_jobs.wait(job) for job in jobs))
+        )
+
+        return {
+            "durationSeconds": time.perf_counter() - started,
+            "files": [
+                result if result is not None else next(finished).to_dict()
+                for result in results
+            ],
+        }
+
+    def get_incremental_config(self, file_detail, formats) -> Dict:
+        """Incremental settings for the export, the watermark is None for a full run.
+
+        Catalog entries opt in with "incremental": {"column": ..., "type":
+        "int" | "timestamp", "key": ...}. Without a key new rows are appended,
+        with one they replace existing rows with the same key. The first run,
+        and any run whose exports can't be appended to, is a full refresh.
+        """
+        config = file_detail and file_detail.get("incremental")
+        if not config:
+            return None
+
+        incremental = {
+            "column": config["column"],
+            "key": config.get("key"),
+            "watermark": load_watermark(config, file_detail.get("watermark")),
+        }
+        if incremental["watermark"] is not None:
+            export_formats = [
+                get_export_format(name) for name in with_precompressed(formats)
+            ]
+            filename = file_detail["fileName"].lower()
+            if not all(
+                export_format.appendable
+                and os.path.exists(
+                    os.path.join(self.data_path, filename + export_format.extension)
+                )
+                for export_format in export_formats
+            ):
+                logging.warning(f"Running a full refresh of {filename}")
+                incremental["watermark"] = None
+
+        return incremental
+
+    def get_export_limits(self, file_detail) -> Dict:
+        """maxRows, maxBytes and spillRows set on the catalog entry"""
+        limits = {}
+        for name in ("maxRows", "maxBytes", "spillRows"):
+            value = file_detail and file_detail.get(name)
+            if value is None:
+                continue
+            try:
+                limit = int(value)
+                valid = limit >= 0 and limit == float(value)
+            except (TypeError, ValueError):
+                valid = False
+            if not valid or isinstance(value, bool):
+                raise ValueError(
+                    f"{name} of {file_detail['fileName']} must be a whole number "
+                    f"of 0 or more, got {value!r}"
+                )
+            limits[name] = limit
+        return limits
+
+    async def _refresh(self, database, filename) -> None:
         """Run query -> Save dataframe into csv file in data folder"""
+        file_detail = await run_catalog_io(self.get_file_detail, filename)
+        formats = await run_catalog_io(self.get_export_formats, filename)
+        incremental = self.get_incremental_config(file_detail, formats)
+        limits = self.get_export_limits(file_detail)
+        started = time.perf_counter()
+        export = {"rows": 0, "bytes": 0, "changed": False, "watermark": None}
         if database == "MY":
-            await mysql_db_instance.execute_query_path(filename=filename)
+            export = await mysql_db_instance.execute_query_path(
+                filename=filename,
+                formats=formats,
+                incremental=incremental,
+                limits=limits,
+            )
         elif database == "PG":
-            await pg_db_instance.execute_query_path(filename=filename)
+            export = await pg_db_instance.execute_query_path(
+                filename=filename,
+                formats=formats,
+                incremental=incremental,
+                limits=limits,
+            )
+        elapsed = time.perf_counter() - started
+        EXPORT_ROWS.inc(export["rows"], database=database)
+        EXPORT_BYTES.inc(export["bytes"], database=database)
+        if SLOW_REFRESH_SECONDS and elapsed > SLOW_REFRESH_SECONDS:
+            logging.warning(
+                f"Slow refresh of {filename} took {elapsed:.1f}s, "
+                f"{export['rows']} rows, {export['bytes']} bytes"
+            )
+
+        now = datetime.now()
+        # Size of the last run, to plan limits and capacity from real numbers
+        changes = {
+            "updatedAt": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "lastRunRows": export["rows"],
+            "lastRunBytes": export["bytes"],
+            "lastRunSeconds": round(elapsed, 3),
+        }
+        if incremental:
+            changes["watermark"] = dump_watermark(export["watermark"])
+        file_detail = await run_catalog_io(
+            self.metadata.update_entry, filename, **changes
+        )
+        await run_coordination_io(
+            self.coordination.set,
+            f"cooldown:{filename}",
+            now.isoformat(),
+            ttl=REFRESH_COOLDOWN.total_seconds(),
+        )
+
+        if not export["changed"]:
+            logging.info(f"Export of {filename} unchanged, subscribers not notified")
+            return
+
+        # Push the new catalog entry to subscribers instead of them polling
+        if file_detail is not None:
+            EventBrokerInstance.publish(
+                {"type": "file_updated", "file": dict(file_detail)},
+                file_detail["role"],
+            )
+
+    def _export_targets(self, filename) -> List[str]:
+        return [
+            os.path.join(self.data_path, filename + get_export_format(name).extension)
+            for name in with_precompressed(self.get_export_formats(filename))
+        ]
+
+    def get_versions(self, filename) -> Dict[str, List[Dict]]:
+        """Kept versions of each export file of the entry, newest first"""
+        return {
+            os.path.basename(target): ExportStoreInstance.versions(target)
+            for target in self._export_targets(filename)
+        }
+
+    async def rollback(self, filename, version) -> Dict:
+        """Point every export file of the entry back at an older version.
+
+        version counts back from the current one, 1 is the previous export.
+        Incremental entries lose their watermark so the next refresh is full.
+        """
+        file_detail = await run_catalog_io(self.get_file_detail, filename)
+        if file_detail is None:
+            raise HTTPException(status_code=404, detail=f"File not found {filename}")
 
-        self.check_get_update(filename, "put_update")
+        targets = await run_catalog_io(self._export_targets, filename)
+        kept = await run_catalog_io(self.get_versions, filename)
+        hashes = []
+        for target in targets:
+            versions = kept[os.path.basename(target)]
+            if version >= len(versions):
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Version {version} of {os.path.basename(target)} not kept",
+                )
+            hashes.append(versions[version]["hash"])
+
+        for target, digest in zip(targets, hashes):
+            if not await run_export_io(ExportStoreInstance.rollback, target, digest):
+                raise HTTPException(
+                    status_code=409, detail=f"Could not roll back {target}"
+                )
+
+        changes = {"updatedAt": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        if file_detail.get("incremental"):
+            changes["watermark"] = None
+        file_detail = await run_catalog_io(
+            self.metadata.update_entry, filename, **changes
+        )
+        EventBrokerInstance.publish(
+            {"type": "file_updated", "file": dict(file_detail)}, file_detail["role"]
+        )
+        return file_detail
 
     async def update_mysql(self, filename) -> None:
         """re-run query and download to folder data"""
         try:
-            await mysql_db_instance.execute_query_path(filename=filename)
+            formats = await run_catalog_io(self.get_export_formats, filename)
+            await mysql_db_instance.execute_query_path(
+                filename=filename, formats=formats
+            )
         except Exception as error:
             raise HTTPException(
                 status_code=500, detail=f"Error executing query: {error}"
             )
 
 
+def _collect_gauges():
+    """Pool occupancy and refresh jobs in flight, read at scrape time"""
+    pools = {
+        "PG": pg_db_instance.get_pool_stats(),
+        "MY": mysql_db_instance.get_pool_stats(),
+    }
+    yield (
+        "db_pool_connections",
+        "Pooled database connections by state",
+        [
+            ({"database": database, "state": state}, stats[key])
+            for database, stats in pools.items()
+            for state, key in (("size", "size"), ("idle", "idle"), ("in_use", "inUse"))
+        ],
+    )
+    yield (
+        "refresh_jobs_inflight",
+        "Refresh jobs queued or running in this worker",
+        [({}, ApiLogicInstance.refresh_jobs.inflight_count())],
+    )
+    yield (
+        "event_subscribers",
+        "Connected WebSocket and SSE subscribers",
+        [({}, EventBrokerInstance.subscriber_count)],
+    )
+
+
 ApiLogicInstance = ApiLogic()
+metrics.register_collector(_collect_gauges)
@@ -0,0 +1,145 @@
+from typing import List, Dict
+from contextlib import contextmanager
+from datetime import date, datetime
+import os
+import json
+import fcntl
+import tempfile
+import threading
+
+
+def load_watermark(incremental, value):
+    """Parse a stored watermark according to the incremental "type" setting"""
+    if value is None:
+        return None
+
+    watermark_type = incremental.get("type", "int")
+    if watermark_type == "timestamp":
+        return datetime.fromisoformat(value)
+    elif watermark_type == "int":
+        return int(value)
+    return value
+
+
+def dump_watermark(value):
+    """Make a watermark read from the database JSON serialisable"""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    elif value is None or isinstance(value, (int, float, str)):
+        return value
+    return str(value)
+
+
+class MetadataStore:
+    """In-memory copy of data/file_metadata.json.
+
+    The catalog is parsed once and re-read only when the file's inode, mtime or
+    size changes. Entries are indexed by role and by lowercased file name so
+    lookups don't scan the whole list. Returned entries are shared with the
+    cache and must be treated as read-only, use update_entry to change them.
+
+    Writes are safe across worker processes: they hold an exclusive flock on a
+    sibling .lock file, re-read the catalog from disk, and replace it with a
+    fully written temp file so readers see either the old or the new catalog.
+    Within a process an RLock makes it safe to call from the catalog I/O threads.
+    """
+
+    def __init__(self, json_file_path) -> None:
+        self.json_file_path = json_file_path
+        self.lock_path = json_file_path + ".lock"
+        self._stat_key = None
+        self._details = []
+        self._by_role = {}
+        self._by_name = {}
+        self._lock = threading.RLock()
+
+    def _load(self, force=False) -> None:
+        with self._lock:
+            stat = os.stat(self.json_file_path)
+            stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stat_key == self._stat_key and not force:
+                return
+
+            with open(self.json_file_path, "r") as file:
+                details = json.load(file)
+
+            self._index(details)
+            self._stat_key = stat_key
+
+    def _index(self, details) -> None:
+        by_role = {}
+        by_name = {}
+        for file_detail in details:
+            by_role.setdefault(file_detail["role"], []).append(file_detail)
+            by_name.setdefault(file_detail["fileName"].lower(), file_detail)
+
+        self._details = details
+        self._by_role = by_role
+        self._by_name = by_name
+
+    def exists(self) -> bool:
+        return os.path.exists(self.json_file_path)
+
+    def all(self) -> List[Dict]:
+        self._load()
+        return self._details
+
+    def by_role(self, role) -> List[Dict]:
+        self._load()
+        return self._by_role.get(role, [])
+
+    def find(self, filename) -> Dict:
+        """Entry whose lowercased fileName matches, else the first containing it"""
+        self._load()
+        filename = filename.lower()
+        file_detail = self._by_name.get(filename)
+        if file_detail is not None:
+            return file_detail
+
+        for file_detail in self._details:
+            if filename in file_detail["fileName"].lower():
+                return file_detail
+        return None
+
+    @contextmanager
+    def _write_lock(self):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, details) -> None:
+        directory = os.path.dirname(self.json_file_path)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=directory, prefix=".file_metadata.", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(details, file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.json_file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self._index(details)
+        stat = os.stat(self.json_file_path)
+        self._stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def update_entry(self, filename, **changes) -> Dict:
+        """Apply changes to the file's entry and write the catalog back"""
+        with self._lock, self._write_lock():
+            # Another worker may have written since our last read
+            self._load(force=True)
+            file_detail = self.find(filename)
+            if file_detail is None:
+                return None
+
+            file_detail.update(changes)
+            self._write(self._details)
+            return file_detail
@@ -0,0 +1,124 @@
+from typing import Dict, List
+from utils.blocking_io import run_catalog_io, read_text
+import logging
+import os
+import re
+
+logging.basicConfig(level=logging.INFO)
+
+QUERY_PATH = os.path.join(os.path.dirname(__file__), "query")
+QUERY_DIRECTORIES = {"PG": "postgres", "MY": "mysql"}
+
+
+class CatalogQuery:
+    def __init__(self, database, name, path, text, stat_key) -> None:
+        self.database = database
+        self.name = name
+        self.path = path
+        self.text = text
+        self.stat_key = stat_key
+
+
+def _statement_count(text) -> int:
+    """Statements in the text, ignoring ; inside quotes or comments"""
+    text = re.sub(r"--[^\n]*|/\*.*?\*/", " ", text, flags=re.DOTALL)
+    count = 0
+    quote = None
+    pending = False
+    for char in text:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in ("'", '"', "`"):
+            quote = char
+            pending = True
+        elif char == ";":
+            count += pending
+            pending = False
+        elif not char.isspace():
+            pending = True
+    return count + pending
+
+
+def validate_query(database, text) -> str:
+    """Normalized query text, raises ValueError if it can't be run"""
+    text = text.strip()
+    if not text:
+        raise ValueError("Query file is empty")
+    if database == "PG":
+        # Run through a cursor and wrapped for incremental refreshes, so it
+        # must be a single statement
+        if _statement_count(text) != 1:
+            raise ValueError("Postgres query files must hold a single statement")
+        text = text.rstrip(";").strip()
+    return text
+
+
+class QueryRegistry:
+    """The .sql files under services/query, read and validated once.
+
+    get() checks the file's mtime and size on every call and re-reads it only
+    when it changed, so edited queries apply on the next refresh without a
+    restart. Keeping the text identical between refreshes also lets the
+    driver's statement cache, when PG_STATEMENT_CACHE_SIZE enables it, reuse
+    the server-side prepared statement.
+    """
+
+    def __init__(self, root) -> None:
+        self.root = root
+        self._queries = {}
+
+    def _path(self, database, name) -> str:
+        return os.path.join(self.root, QUERY_DIRECTORIES[database], name + ".sql")
+
+    def _read(self, database, name) -> CatalogQuery:
+        path = self._path(database, name)
+        stat = os.stat(path)
+        text = validate_query(database, read_text(path))
+        query = CatalogQuery(
+            database, name, path, text, (stat.st_mtime_ns, stat.st_size)
+        )
+        self._queries[(database, name)] = query
+        return query
+
+    def load(self) -> Dict[str, List[str]]:
+        """Read every query file, returns the invalid ones with their errors"""
+        errors = {}
+        for database, directory in QUERY_DIRECTORIES.items():
+            directory = os.path.join(self.root, directory)
+            if not os.path.isdir(directory):
+                continue
+            for entry in sorted(os.listdir(directory)):
+                name, extension = os.path.splitext(entry)
+                if extension != ".sql":
+                    continue
+                try:
+                    self._read(database, name)
+                except (OSError, ValueError) as error:
+                    errors.setdefault(database, []).append(f"{entry}: {error}")
+                    logging.error(f"Invalid query file {entry}: {error}")
+
+        logging.info(f"Loaded {len(self._queries)} catalog queries")
+        return errors
+
+    def queries(self, database) -> List[CatalogQuery]:
+        return [query for query in self._queries.values() if query.database == database]
+
+    async def get(self, database, name) -> CatalogQuery:
+        """The query, re-read if its file changed, None if there is no such file"""
+        try:
+            stat = os.stat(self._path(database, name))
+        except FileNotFoundError:
+            self._queries.pop((database, name), None)
+            return None
+
+        query = self._queries.get((database, name))
+        if query is not None and query.stat_key == (stat.st_mtime_ns, stat.st_size):
+            return query
+
+        if query is not None:
+            logging.info(f"Reloading changed query file {query.path}")
+        return await run_catalog_io(self._read, database, name)
+
+
+QueryRegistryInstance = QueryRegistry(QUERY_PATH)
@@ -1,68 +1,329 @@
 from fastapi import APIRouter
-from fastapi import FastAPI, HTTPException, Request, Depends
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Request, Depends, Query
+from fastapi.responses import FileResponse, Response
+from email.utils import formatdate, parsedate_to_datetime
 from services.logic import ApiLogicInstance
-from sqlalchemy.orm import Session
-from utils.auth_utils import verify_token
+from db.db_config import pg_db_instance
+from db_mysql.db_config import mysql_db_instance
+from services.users import UserRepositoryInstance
+from services.dataset import DatasetStoreInstance, DATA_MAX_PAGE_SIZE
+from utils.auth_utils import verify_token, verify_token_payload
+from utils.export_formats import get_export_format
+from utils.export_store import ExportStoreInstance
+from utils.blocking_io import run_catalog_io, run_export_io
+from utils.rate_limit import rate_limit
 import os
 import logging
 from pydantic import BaseModel
-from database import get_db
-from models import User
+from typing import List, Optional
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 
 class FileUpdateRequest(BaseModel):
-    db: str
+    # The database comes from the catalog entry, a given one must match it
+    db: Optional[str] = None
     filename: str
 
 
-router = APIRouter()
+class BatchRefreshRequest(BaseModel):
+    filenames: Optional[List[str]] = None
+    role: Optional[str] = None
 
 
-@router.get("/files")
-async def get_files(
-    current_user: str = Depends(verify_token), db: Session = Depends(get_db)
-):
+class RollbackRequest(BaseModel):
+    version: int = 1
 
-    check_user = db.query(User).filter(User.username == current_user).first()
 
-    if not check_user:
+router = APIRouter()
+
+
+async def get_current_role(payload: dict = Depends(verify_token_payload)) -> str:
+    # Tokens issued at login carry the role, older ones fall back to a lookup
+    role = payload.get("role")
+    if role is None:
+        role = await UserRepositoryInstance.get_role(payload["sub"])
+
+    if role is None:
         raise HTTPException(status_code=401, detail="User not found")
+    return role
+
 
-    details = ApiLogicInstance.get_filenames_details(role=check_user.role)
+async def visible_filenames(role) -> set:
+    details = await run_catalog_io(ApiLogicInstance.get_filenames_details, role)
+    return {file_detail["fileName"].lower() for file_detail in details}
+
+
+@router.get("/files", dependencies=[Depends(rate_limit("api"))])
+async def get_files(role: str = Depends(get_current_role)):
+    details = await run_catalog_io(ApiLogicInstance.get_filenames_details, role)
     return details
 
 
-@router.post("/download/")
-async def download_file(request: Request, current_user: str = Depends(verify_token)):
-    data = await request.json()
-    filename = data.get("filename").lower()
+@router.get("/files/{filename}/versions", dependencies=[Depends(rate_limit("api"))])
+async def get_file_versions(filename: str, role: str = Depends(get_current_role)):
+    """Export versions kept for rollback, newest (current) first"""
+    filename = filename.lower()
+    if filename not in await visible_filenames(role):
+        raise HTTPException(status_code=404, detail=f"File not found {filename}")
+
+    return await run_catalog_io(ApiLogicInstance.get_versions, filename)
+
+
+@router.post(
+    "/files/{filename}/rollback", dependencies=[Depends(rate_limit("refresh"))]
+)
+async def rollback_file(
+    filename: str, request: RollbackRequest, role: str = Depends(get_current_role)
+):
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can roll back")
+    if request.version < 1:
+        raise HTTPException(status_code=400, detail="Version must be 1 or more")
+
+    return await ApiLogicInstance.rollback(filename.lower(), request.version)
+
+
+@router.get("/data/{filename}", dependencies=[Depends(rate_limit("api"))])
+async def query_data(
+    filename: str,
+    columns: Optional[str] = None,
+    where: List[str] = Query([]),
+    sort: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=DATA_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    role: str = Depends(get_current_role),
+):
+    """Rows of an export, e.g. ?columns=a,b&where=Prefecture:eq:Tokyo&sort=-Year"""
+    filename = filename.lower()
+    if filename not in await visible_filenames(role):
+        raise HTTPException(status_code=404, detail=f"File not found {filename}")
+
+    # Reads, and converts on first use, the export file on the export threads
+    return await run_export_io(
+        DatasetStoreInstance.query,
+        filename,
+        columns=columns.split(",") if columns else None,
+        filters=where,
+        sort=sort.split(",") if sort else None,
+        limit=limit,
+        cursor=cursor,
+    )
+
 
+def resolve_download(filename, format_name):
+    """Export format and path of the file to download, 4xx if unavailable"""
     if not filename:
         raise HTTPException(status_code=400, detail="Filename is required")
+    if os.path.basename(filename) != filename:
+        raise HTTPException(status_code=400, detail="Invalid filename")
 
-    file_path = os.path.join("../api/data", filename + ".csv")
+    # Requested format, else the default format configured for the file
+    if not format_name:
+        format_name = ApiLogicInstance.get_export_formats(filename)[0]
+    try:
+        export_format = get_export_format(format_name)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+    file_path = os.path.join(
+        ApiLogicInstance.data_path, filename + export_format.extension
+    )
     logging.info(f"Requested file path: {file_path}")
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail=f"File not found {file_path}")
 
-    return FileResponse(file_path, status_code=200, filename=filename)
+    return export_format, file_path
+
+
+@router.post("/download/", dependencies=[Depends(rate_limit("download"))])
+async def download_file(request: Request, current_user: str = Depends(verify_token)):
+    data = await request.json()
+    filename = (data.get("filename") or "").lower()
+    export_format, file_path = await run_catalog_io(
+        resolve_download, filename, data.get("format")
+    )
+
+    ApiLogicInstance.record_download(filename)
+    return FileResponse(
+        file_path,
+        status_code=200,
+        media_type=export_format.media_type,
+        filename=filename + export_format.extension,
+    )
 
 
-@router.put("/files")
+def _accepted_encodings(request: Request) -> List[str]:
+    accepted = []
+    for part in request.headers.get("accept-encoding", "").split(","):
+        encoding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.append(encoding.strip().lower())
+    return accepted
+
+
+def _not_modified(request: Request, response: FileResponse) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = response.headers["etag"]
+        candidates = [
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+        ]
+        return "*" in candidates or etag in candidates
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+            modified = parsedate_to_datetime(response.headers["last-modified"])
+        except (TypeError, ValueError):
+            return False
+        return modified <= since
+
+    return False
+
+
+def _select_representation(export_format, file_path, accepted):
+    """Served path, headers and stat of the export or its precompressed sibling"""
+    served_path = file_path
+    headers = {}
+    if export_format.precompressed:
+        headers["Vary"] = "Accept-Encoding"
+        for encoding, extension in (("zstd", ".zst"), ("gzip", ".gz")):
+            sibling = file_path + extension
+            if (
+                encoding in accepted
+                and encoding in export_format.precompressed
+                and os.path.exists(sibling)
+                and ExportStoreInstance.modified_ns(sibling)
+                >= ExportStoreInstance.modified_ns(file_path)
+            ):
+                served_path = sibling
+                headers["Content-Encoding"] = encoding
+                break
+
+    stat_result = os.stat(served_path)
+    # Blobs are shared between names, validators come from the name's version
+    pointer = ExportStoreInstance.pointer(served_path)
+    if pointer is not None:
+        headers["ETag"] = f'"{pointer["hash"]}"'
+        modified = pointer.get("pointedAt") or stat_result.st_mtime_ns
+        headers["Last-Modified"] = formatdate(modified / 1e9, usegmt=True)
+    return served_path, headers, stat_result
+
+
+@router.get("/download/{filename}", dependencies=[Depends(rate_limit("download"))])
+async def download_file_get(
+    filename: str,
+    request: Request,
+    format: Optional[str] = None,
+    current_user: str = Depends(verify_token),
+):
+    """Download with ETag/Last-Modified validators and byte range support.
+
+    A precompressed .zst/.gz sibling written at export time is served when the
+    client accepts that encoding and it is at least as new as the export.
+    """
+    filename = filename.lower()
+    export_format, file_path = await run_catalog_io(resolve_download, filename, format)
+    ApiLogicInstance.record_download(filename)
+
+    served_path, headers, stat_result = await run_catalog_io(
+        _select_representation, export_format, file_path, _accepted_encodings(request)
+    )
+    response = FileResponse(
+        served_path,
+        status_code=200,
+        media_type=export_format.media_type,
+        filename=filename + export_format.extension,
+        headers=headers,
+        stat_result=stat_result,
+    )
+
+    if _not_modified(request, response):
+        not_modified_headers = {
+            name: response.headers[name]
+            for name in ("etag", "last-modified", "vary", "content-encoding")
+            if name in response.headers
+        }
+        return Response(status_code=304, headers=not_modified_headers)
+
+    return response
+
+
+@router.put("/files", status_code=202, dependencies=[Depends(rate_limit("refresh"))])
 async def update_file(
     request: FileUpdateRequest,
+    role: str = Depends(get_current_role),
 ):
-    db = request.db
     filename = request.filename.lower()
+    if filename not in await visible_filenames(role):
+        raise HTTPException(status_code=404, detail=f"File not found {filename}")
+
+    file_detail = await run_catalog_io(ApiLogicInstance.get_file_detail, filename)
+    if file_detail is None:
+        raise HTTPException(status_code=404, detail=f"File not found {filename}")
+    db = file_detail["db"]
+    if request.db is not None and request.db != db:
+        raise HTTPException(
+            status_code=400, detail=f"File {filename} is not in {request.db}"
+        )
 
     logging.info(f"Updating file {filename}")
     try:
-        await ApiLogicInstance.update_file(db, filename)
-        return {"message": f"File {filename} updated successfully"}
+        job = await ApiLogicInstance.submit_refresh(db, filename)
+        return {"message": f"File {filename} refresh {job.status}", **job.to_dict()}
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error updating file: {e}")
         raise HTTPException(status_code=500, detail=f"Error updating file: {e}")
+
+
+@router.post("/files/refresh", dependencies=[Depends(rate_limit("refresh"))])
+async def refresh_files(
+    request: BatchRefreshRequest, role: str = Depends(get_current_role)
+):
+    if request.filenames is None and request.role is None:
+        raise HTTPException(status_code=400, detail="Filenames or role is required")
+
+    if role != "admin":
+        # Users may only refresh the files they can see
+        if request.role not in (None, role):
+            raise HTTPException(status_code=403, detail="Not allowed for this role")
+        if request.filenames is not None:
+            hidden = {filename.lower() for filename in request.filenames} - (
+                await visible_filenames(role)
+            )
+            if hidden:
+                raise HTTPException(
+                    status_code=403,
+                    detail=f"Not allowed to refresh {', '.join(sorted(hidden))}",
+                )
+
+    return await ApiLogicInstance.refresh_batch(
+        filenames=request.filenames, role=request.role
+    )
+
+
+@router.get("/jobs/{job_id}", dependencies=[Depends(rate_limit("api"))])
+async def get_refresh_job(job_id: str, role: str = Depends(get_current_role)):
+    job = await ApiLogicInstance.refresh_jobs.get(job_id)
+    # Jobs of files the role cannot see are reported as missing
+    if job is None or job.filename not in await visible_filenames(role):
+        raise HTTPException(status_code=404, detail=f"Job not found {job_id}")
+
+    return job.to_dict()
+
+
+@router.get("/pools", dependencies=[Depends(rate_limit("api"))])
+async def get_pool_stats(role: str = Depends(get_current_role)):
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can see the pools")
+
+    return {
+        "PG": pg_db_instance.get_pool_stats(),
+        "MY": mysql_db_instance.get_pool_stats(),
+    }
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from services.logic import ApiLogicInstance
+from utils.blocking_io import run_catalog_io
+import asyncio
+import logging
+import os
+import random
+
+logging.basicConfig(level=logging.INFO)
+
+# Interval for catalog entries without "refreshIntervalMinutes", 0 disables them
+REFRESH_INTERVAL_MINUTES = float(os.getenv("REFRESH_INTERVAL_MINUTES", 0))
+# Each interval is stretched or shrunk by up to this fraction
+REFRESH_JITTER = float(os.getenv("REFRESH_JITTER", 0.1))
+# Files not downloaded within this window are skipped, 0 refreshes them anyway
+REFRESH_IDLE_MINUTES = float(os.getenv("REFRESH_IDLE_MINUTES", 60))
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", 30))
+
+
+class RefreshScheduler:
+    """Refresh catalog entries in the background on their own interval.
+
+    First runs are spread randomly over one interval and every later run gets
+    some jitter, so refreshes don't all reach the database at once. Refreshes
+    go through the job queue, which applies the cooldown and single-flight.
+    """
+
+    def __init__(self, api_logic) -> None:
+        self.api_logic = api_logic
+        self._next_run = {}
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logging.info("Refresh scheduler started")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _interval(self, file_detail) -> timedelta:
+        minutes = file_detail.get("refreshIntervalMinutes", REFRESH_INTERVAL_MINUTES)
+        return timedelta(minutes=minutes) if minutes else None
+
+    def _recently_downloaded(self, filename, now) -> bool:
+        if not REFRESH_IDLE_MINUTES:
+            return True
+
+        last_downloaded = self.api_logic.last_downloaded.get(filename)
+        return bool(last_downloaded) and last_downloaded > now - timedelta(
+            minutes=REFRESH_IDLE_MINUTES
+        )
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.tick(datetime.now())
+            except Exception as error:
+                logging.error(f"Refresh scheduler error: {error}")
+            await asyncio.sleep(SCHEDULER_TICK_SECONDS)
+
+    async def tick(self, now) -> None:
+        """Submit a refresh for every entry whose next run is due"""
+        for file_detail in await run_catalog_io(self.api_logic.metadata.all):
+            interval = self._interval(file_detail)
+            if interval is None:
+                continue
+
+            filename = file_detail["fileName"].lower()
+            next_run = self._next_run.get(filename)
+            if next_run is None:
+                self._next_run[filename] = now + interval * random.random()
+                continue
+            if next_run > now:
+                continue
+
+            jitter = 1 + random.uniform(-REFRESH_JITTER, REFRESH_JITTER)
+            self._next_run[filename] = now + interval * jitter
+
+            if not self._recently_downloaded(filename, now):
+                continue
+
+            try:
+                job = await self.api_logic.submit_refresh(file_detail["db"], filename)
+                logging.info(f"Scheduled refresh of {filename}, job {job.id}")
+            except HTTPException as error:
+                logging.info(
+                    f"Skipping scheduled refresh of {filename}: {error.detail}"
+                )
+
+
+RefreshSchedulerInstance = RefreshScheduler(ApiLogicInstance)
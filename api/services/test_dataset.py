@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import json
+import os
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from services.dataset import DatasetStore
+from utils.export_store import ExportStore
+import services.dataset
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(services.dataset, "ExportStoreInstance", ExportStore())
+    write_export(tmp_path, range(10))
+    return DatasetStore(str(tmp_path))
+
+
+def write_export(path, values):
+    target = path / "numbers.csv"
+    tmp_path = path / "numbers.csv.tmp"
+    tmp_path.write_text("n,parity\n" + "".join(f"{n},{n % 2}\n" for n in values))
+    services.dataset.ExportStoreInstance.commit(str(tmp_path), str(target))
+
+
+def pages(store, **query):
+    cursor = None
+    while True:
+        page = store.query("numbers", cursor=cursor, **query)
+        yield page
+        cursor = page["nextCursor"]
+        if cursor is None:
+            return
+
+
+def test_cursor_walks_every_row_once(store):
+    result = list(pages(store, limit=3, sort=["-n"]))
+
+    assert [len(page["rows"]) for page in result] == [3, 3, 3, 1]
+    assert [row["n"] for page in result for row in page["rows"]] == list(
+        range(9, -1, -1)
+    )
+
+
+def test_cursor_keeps_filters_and_projection(store):
+    result = list(pages(store, limit=2, columns=["n"], filters=["parity:eq:1"]))
+
+    assert [row for page in result for row in page["rows"]] == [
+        {"n": n} for n in (1, 3, 5, 7, 9)
+    ]
+
+
+def test_cursor_is_rejected_once_the_export_changes(store, tmp_path):
+    first = store.query("numbers", limit=3)
+
+    write_export(tmp_path, range(20))
+
+    with pytest.raises(HTTPException) as error:
+        store.query("numbers", limit=3, cursor=first["nextCursor"])
+    assert error.value.status_code == 409
+    assert store.query("numbers", limit=30)["rows"][-1]["n"] == 19
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    ["not-a-cursor", base64.urlsafe_b64encode(json.dumps({"offset": -1}).encode())],
+)
+def test_invalid_cursors_are_rejected(store, cursor):
+    if isinstance(cursor, bytes):
+        cursor = cursor.decode()
+
+    with pytest.raises(HTTPException) as error:
+        store.query("numbers", cursor=cursor)
+    assert error.value.status_code == 400
+
+
+def test_workers_converting_the_same_export_at_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(services.dataset, "ExportStoreInstance", ExportStore())
+    write_export(tmp_path, range(1000))
+    # Separate stores have separate locks, like the stores of two workers
+    stores = [DatasetStore(str(tmp_path)) for _ in range(4)]
+    # Every conversion is written before the first one is moved in place
+    written = threading.Barrier(len(stores), timeout=10)
+    replace = os.replace
+
+    def replace_when_all_written(source, target):
+        written.wait()
+        replace(source, target)
+
+    monkeypatch.setattr(os, "replace", replace_when_all_written)
+
+    with ThreadPoolExecutor(max_workers=len(stores)) as executor:
+        results = list(
+            executor.map(lambda store: store.query("numbers", limit=1), stores)
+        )
+
+    assert [result["rows"] for result in results] == [[{"n": 0, "parity": 0}]] * 4
+    cache_path = stores[0].cache_path
+    assert not [entry for entry in os.listdir(cache_path) if entry.endswith(".tmp")]
@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from services.jobs import RefreshJob, RefreshJobQueue, RemoteRefreshJob
+from utils.coordination import LocalBackend, SQLiteBackend
+import services.jobs
+
+
+class Refreshes:
+    """run_refresh stand-in counting calls, each one takes delay seconds"""
+
+    def __init__(self, delay=0.05, error=None) -> None:
+        self.delay = delay
+        self.error = error
+        self.calls = []
+
+    async def __call__(self, database, filename) -> None:
+        self.calls.append((database, filename))
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise RuntimeError(self.error)
+
+
+def test_concurrent_submits_run_one_refresh():
+    refreshes = Refreshes()
+    checks = []
+
+    async def check(filename):
+        checks.append(filename)
+        await asyncio.sleep(0.01)
+
+    async def run():
+        queue = RefreshJobQueue(refreshes, {"PG": 1}, LocalBackend())
+        jobs = await asyncio.gather(
+            *(queue.submit("PG", "stations", check=check) for _ in range(5))
+        )
+        return await queue.wait(jobs[0]), {job.id for job in jobs}
+
+    job, job_ids = asyncio.run(run())
+
+    assert job.status == "succeeded"
+    assert job_ids == {job.id}
+    assert refreshes.calls == [("PG", "stations")]
+    assert checks == ["stations"]
+
+
+def test_refused_submit_releases_the_lease():
+    backend = LocalBackend()
+
+    async def refuse(filename):
+        raise HTTPException(status_code=400, detail="cooling down")
+
+    async def run():
+        queue = RefreshJobQueue(Refreshes(), {"PG": 1}, backend)
+        with pytest.raises(HTTPException):
+            await queue.submit("PG", "stations", check=refuse)
+        assert backend.owner("refresh:stations") is None
+        return await queue.wait(await queue.submit("PG", "stations"))
+
+    assert asyncio.run(run()).status == "succeeded"
+
+
+def test_failed_refresh_is_reported_and_frees_the_file():
+    backend = LocalBackend()
+
+    async def run():
+        queue = RefreshJobQueue(Refreshes(error="boom"), {"PG": 1}, backend)
+        return await queue.wait(await queue.submit("PG", "stations"))
+
+    job = asyncio.run(run())
+
+    assert (job.status, job.error) == ("failed", "boom")
+    assert backend.owner("refresh:stations") is None
+    assert backend.get(f"job:{job.id}")["status"] == "failed"
+
+
+def test_submit_joins_the_job_of_another_worker(monkeypatch):
+    monkeypatch.setattr(services.jobs, "REMOTE_JOB_POLL_SECONDS", 0.01)
+    backend = LocalBackend()
+
+    async def run():
+        owner = RefreshJobQueue(Refreshes(delay=0.2), {"PG": 1}, backend)
+        other = RefreshJobQueue(Refreshes(), {"PG": 1}, backend)
+        job = await owner.submit("PG", "stations")
+        joined = await other.submit("PG", "stations")
+        return job, joined, await other.wait(joined)
+
+    job, joined, finished = asyncio.run(run())
+
+    assert isinstance(job, RefreshJob)
+    assert isinstance(joined, RemoteRefreshJob)
+    assert joined.id == job.id
+    assert finished.status == "succeeded"
+
+
+def test_orphaned_remote_job_is_reported_as_interrupted(monkeypatch):
+    monkeypatch.setattr(services.jobs, "REMOTE_JOB_POLL_SECONDS", 0.01)
+    backend = LocalBackend()
+    job = RemoteRefreshJob(services.jobs._pending_record("gone", "PG", "stations"))
+
+    async def run():
+        queue = RefreshJobQueue(Refreshes(), {"PG": 1}, backend)
+        return await queue.wait(job)
+
+    finished = asyncio.run(run())
+
+    assert (finished.status, finished.error) == ("failed", "Refresh was interrupted")
+
+
+def test_long_refresh_keeps_its_lease(monkeypatch):
+    monkeypatch.setattr(services.jobs, "REFRESH_LEASE_SECONDS", 0.15)
+    backend = LocalBackend()
+
+    async def run():
+        queue = RefreshJobQueue(Refreshes(delay=0.5), {"PG": 1}, backend)
+        job = await queue.submit("PG", "stations")
+        await asyncio.sleep(0.4)
+        owner = backend.owner("refresh:stations")
+        await queue.wait(job)
+        return job, owner
+
+    job, owner = asyncio.run(run())
+
+    assert owner == job.id
+    assert job.status == "succeeded"
+
+
+def test_busy_sqlite_backend_does_not_stall_the_loop(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "coordination.sqlite3"))
+    backend.owner("refresh:stations")  # connect before the lock is taken
+    locked = threading.Event()
+
+    def hold_lock():
+        # As take_token does around its BEGIN IMMEDIATE transaction
+        with backend._lock:
+            locked.set()
+            time.sleep(0.5)
+
+    async def run():
+        queue = RefreshJobQueue(Refreshes(), {"PG": 1}, backend)
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait()
+        submitted = asyncio.create_task(queue.submit("PG", "stations"))
+        lags = []
+        while not submitted.done():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+        job = await queue.wait(await submitted)
+        holder.join()
+        return job, lags
+
+    job, lags = asyncio.run(run())
+
+    assert job.status == "succeeded"
+    # submit waited for the lock the whole time without holding up the loop
+    assert len(lags) > 20
+    assert max(lags) < 0.1
+    assert backend.get(f"job:{job.id}")["status"] == "succeeded"
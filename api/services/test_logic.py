@@ -0,0 +1,93 @@
+import asyncio
+import json
+import time
+
+from benchmarks import standins
+from benchmarks.api_suite import client_for_app, login
+from services.logic import ApiLogicInstance
+from services.metadata import MetadataStore
+from services.users import UserRepositoryInstance
+import services.logic
+
+# Longest a request may take while an export runs in the worker threads
+MAX_REQUEST_SECONDS = 0.25
+
+
+def install_catalog(tmp_path, monkeypatch, filename, rows, formats):
+    """Serve filename from a generated SQLite table through the app's logic"""
+    database = standins.SQLiteDatabase(str(tmp_path / "source.sqlite3"), "")
+    database.create_table("rows", rows)
+    database.tables[filename] = "rows"
+    data_path = tmp_path / "data"
+    data_path.mkdir()
+    database.data_path = str(data_path)
+
+    json_file_path = data_path / "file_metadata.json"
+    json_file_path.write_text(
+        json.dumps(
+            [
+                {
+                    "fileName": filename,
+                    "updatedAt": "2000-01-01 00:00:00",
+                    "db": "PG",
+                    "role": "A",
+                    "formats": formats,
+                }
+            ]
+        )
+    )
+    monkeypatch.setattr(services.logic, "pg_db_instance", database)
+    monkeypatch.setattr(ApiLogicInstance, "data_path", str(data_path))
+    monkeypatch.setattr(ApiLogicInstance, "json_file_path", str(json_file_path))
+    monkeypatch.setattr(
+        ApiLogicInstance, "metadata", MetadataStore(str(json_file_path))
+    )
+    return data_path
+
+
+def test_export_does_not_block_requests(tmp_path, monkeypatch):
+    data_path = install_catalog(
+        tmp_path, monkeypatch, "loop_latency", 200000, ["csv", "parquet"]
+    )
+    for name in ("get_by_username", "update_password", "get_role"):
+        monkeypatch.setattr(
+            UserRepositoryInstance, name, getattr(UserRepositoryInstance, name)
+        )
+    standins.install_user()
+    # Chunks long enough that encoding one on the loop would stall requests
+    monkeypatch.setattr(standins, "EXPORT_CHUNK_SIZE", 50000)
+
+    async def refresh_and_probe():
+        async with client_for_app() as client:
+            headers = {"Authorization": f"Bearer {await login(client)}"}
+            probes = {"/": [], "/api/files": []}
+            refresh_done = asyncio.Event()
+
+            async def probe(path):
+                # Served by the same event loop as the export
+                while not refresh_done.is_set():
+                    started = time.perf_counter()
+                    response = await client.get(path, headers=headers)
+                    response.raise_for_status()
+                    probes[path].append(time.perf_counter() - started)
+                    await asyncio.sleep(0.01)
+
+            probe_tasks = [asyncio.create_task(probe(path)) for path in probes]
+            response = await client.put(
+                "/api/files", json={"filename": "loop_latency"}, headers=headers
+            )
+            response.raise_for_status()
+            job = await ApiLogicInstance.refresh_jobs.get(response.json()["job_id"])
+            job = await ApiLogicInstance.refresh_jobs.wait(job)
+            refresh_done.set()
+            await asyncio.gather(*probe_tasks)
+            return job, probes
+
+    job, probes = asyncio.run(refresh_and_probe())
+
+    assert job.status == "succeeded", job.error
+    assert (data_path / "loop_latency.parquet").exists()
+    for path, latencies in probes.items():
+        # Enough requests that the probes really ran alongside the export
+        assert len(latencies) > 10, path
+        assert max(latencies) < MAX_REQUEST_SECONDS, path
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from benchmarks import standins
+from benchmarks.api_suite import catalog_entry, client_for_app, login
+from services.logic import ApiLogicInstance
+from services.users import UserRepositoryInstance
+import services.logic
+
+
+@pytest.fixture
+def install(tmp_path, monkeypatch):
+    """Serve a stand-in user and catalog through the app, undone after the test"""
+    for name in ("get_by_username", "update_password", "get_role"):
+        monkeypatch.setattr(
+            UserRepositoryInstance, name, getattr(UserRepositoryInstance, name)
+        )
+    for name in ("data_path", "json_file_path", "metadata"):
+        monkeypatch.setattr(ApiLogicInstance, name, getattr(ApiLogicInstance, name))
+    for name in ("pg_db_instance", "mysql_db_instance"):
+        monkeypatch.setattr(services.logic, name, getattr(services.logic, name))
+
+    def install(catalog, role="A"):
+        database = standins.SQLiteDatabase(str(tmp_path / "source.sqlite3"), "")
+        database.create_table("rows", 10)
+        for entry in catalog:
+            database.tables[entry["fileName"]] = "rows"
+        standins.install_database(database, str(tmp_path / "data"), catalog)
+        standins.install_user(role)
+        return tmp_path / "data"
+
+    return install
+
+
+async def finish(client, headers, job):
+    while job["status"] in ("queued", "running"):
+        await asyncio.sleep(0.01)
+        response = await client.get(f"/api/jobs/{job['job_id']}", headers=headers)
+        job = response.json()
+    return job
+
+
+def test_update_file_refreshes_from_the_catalog_database(install):
+    entry = catalog_entry("routes_catalog_db", "csv") | {"db": "MY"}
+    data_path = install([entry])
+
+    async def run():
+        async with client_for_app() as client:
+            headers = {"Authorization": f"Bearer {await login(client)}"}
+            mismatched = await client.put(
+                "/api/files",
+                json={"db": "PG", "filename": "routes_catalog_db"},
+                headers=headers,
+            )
+            response = await client.put(
+                "/api/files", json={"filename": "routes_catalog_db"}, headers=headers
+            )
+            return mismatched, await finish(client, headers, response.json())
+
+    mismatched, job = asyncio.run(run())
+
+    assert mismatched.status_code == 400
+    assert (job["db"], job["status"]) == ("MY", "succeeded")
+    assert (data_path / "routes_catalog_db.csv").exists()
+
+
+def test_jobs_are_visible_to_roles_that_see_the_file(install):
+    install([catalog_entry("routes_job_role", "csv")])
+
+    async def run():
+        async with client_for_app() as client:
+            anonymous = await client.get("/api/jobs/unknown")
+            headers = {"Authorization": f"Bearer {await login(client)}"}
+            response = await client.put(
+                "/api/files", json={"filename": "routes_job_role"}, headers=headers
+            )
+            job = await finish(client, headers, response.json())
+
+            standins.install_user("B")
+            headers = {"Authorization": f"Bearer {await login(client)}"}
+            hidden = await client.get(f"/api/jobs/{job['job_id']}", headers=headers)
+            return anonymous, job, hidden
+
+    anonymous, job, hidden = asyncio.run(run())
+
+    assert anonymous.status_code in (401, 403)
+    assert job["status"] == "succeeded"
+    assert hidden.status_code == 404
+
+
+def test_pool_stats_are_for_admins(install):
+    install([])
+
+    async def run():
+        async with client_for_app() as client:
+            anonymous = await client.get("/api/pools")
+            headers = {"Authorization": f"Bearer {await login(client)}"}
+            user = await client.get("/api/pools", headers=headers)
+
+            standins.install_user("admin")
+            headers = {"Authorization": f"Bearer {await login(client)}"}
+            return anonymous, user, await client.get("/api/pools", headers=headers)
+
+    anonymous, user, admin = asyncio.run(run())
+
+    assert anonymous.status_code in (401, 403)
+    assert user.status_code == 403
+    assert admin.status_code == 200
+    assert set(admin.json()) == {"PG", "MY"}
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from db.db_config import pg_db_instance
+import os
+import time
+
+# How long a username -> role lookup is served from memory
+ROLE_CACHE_TTL_SECONDS = float(os.getenv("ROLE_CACHE_TTL_SECONDS", 60))
+ROLE_CACHE_SIZE = int(os.getenv("ROLE_CACHE_SIZE", 1024))
+
+
+class UserRepository:
+    """Async access to test.users over the shared asyncpg pool.
+
+    Roles are kept in a small TTL/LRU cache so authenticated requests whose
+    token carries no role claim don't need a database round trip each time.
+    """
+
+    def __init__(self, db_instance) -> None:
+        self.db_instance = db_instance
+        self._roles = OrderedDict()
+
+    async def get_by_username(self, username):
+        await self.db_instance.initialize()
+        async with self.db_instance.acquire() as connection:
+            user = await connection.fetchrow(
+                'SELECT id, username, hashed_password, role FROM "test"."users" '
+                "WHERE username = $1",
+                username,
+            )
+
+        if user is not None:
+            self._cache_role(username, user["role"])
+        return user
+
+    async def create(self, username, hashed_password, role="A"):
+        """Insert the user, raises asyncpg.UniqueViolationError if it exists"""
+        await self.db_instance.initialize()
+        async with self.db_instance.acquire() as connection:
+            user = await connection.fetchrow(
+                'INSERT INTO "test"."users" (username, hashed_password, role) '
+                "VALUES ($1, $2, $3) RETURNING id, username, role",
+                username,
+                hashed_password,
+                role,
+            )
+
+        self._cache_role(username, user["role"])
+        return user
+
+    async def update_password(self, username, hashed_password) -> None:
+        await self.db_instance.initialize()
+        async with self.db_instance.acquire() as connection:
+            await connection.execute(
+                'UPDATE "test"."users" SET hashed_password = $2 WHERE username = $1',
+                username,
+                hashed_password,
+            )
+
+    async def get_role(self, username) -> str:
+        cached = self._roles.get(username)
+        if cached is not None and cached[1] > time.monotonic():
+            self._roles.move_to_end(username)
+            return cached[0]
+
+        user = await self.get_by_username(username)
+        return user["role"] if user is not None else None
+
+    def _cache_role(self, username, role) -> None:
+        self._roles[username] = (role, time.monotonic() + ROLE_CACHE_TTL_SECONDS)
+        self._roles.move_to_end(username)
+        while len(self._roles) > ROLE_CACHE_SIZE:
+            self._roles.popitem(last=False)
+
+
+UserRepositoryInstance = UserRepository(pg_db_instance)
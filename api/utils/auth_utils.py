@@ -4,12 +4,38 @@ from jose import JWTError, jwt
 from fastapi.security import OAuth2PasswordBearer
 from fastapi import HTTPException, Depends, status
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from utils.coordination import CoordinationBackendInstance
+from utils.blocking_io import run_catalog_io
+import asyncio
+import hashlib
+import logging
 import os
+import threading
+import time
+import uuid
 
 load_dotenv()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes with fewer rounds are upgraded at their next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# Threads hashing passwords, bcrypt releases the GIL so one per core scales
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", os.cpu_count() or 1))
+# Password operations queued or running before new ones get a 503
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", 64))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+)
+_password_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_WORKERS, thread_name_prefix="password"
+)
+_password_pending = 0
 
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
 REFRESH_TOKEN_EXPIRE_MINUTES = int(os.getenv("REFRESH_TOKEN_EXPIRE_MINUTES"))
@@ -17,6 +43,30 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Signing keys by kid, "kid1:secret1,kid2:secret2". New tokens are signed with
+# JWT_ACTIVE_KID, tokens signed with any listed key stay valid until they
+# expire, so keys can be rotated without logging everybody out.
+SIGNING_KEYS = dict(
+    entry.split(":", 1) for entry in os.getenv("JWT_KEYS", "").split(",") if entry
+)
+ACTIVE_KID = os.getenv("JWT_ACTIVE_KID", "default")
+SIGNING_KEYS.setdefault("default", SECRET_KEY)
+if not SIGNING_KEYS.get(ACTIVE_KID):
+    raise ValueError(
+        f"JWT_ACTIVE_KID {ACTIVE_KID} has no key, add it to JWT_KEYS "
+        f"(known kids: {', '.join(sorted(SIGNING_KEYS))})"
+    )
+# Seconds between reads of the tokens revoked by other workers
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", 5))
+# Verified tokens kept in memory until they expire
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 4096))
+
+# Tokens are decoded on the threadpool, both caches are read and changed
+# under _tokens_lock
+_tokens_lock = threading.Lock()
+_verified_tokens = OrderedDict()
+_revoked_tokens = {}
+
 
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -26,28 +76,164 @@ def verify_password(password: str, hashed_password: str) -> bool:
     return pwd_context.verify(password, hashed_password)
 
 
-def create_access_token(data: dict, expires_delta: timedelta = None):
+async def _run_password_job(func, *args):
+    """Run a bcrypt call on the password executor, shedding load when it's full"""
+    global _password_pending
+    if _password_pending >= PASSWORD_MAX_PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login requests, try again shortly",
+            headers={"Retry-After": "1"},
+        )
+
+    _password_pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, func, *args)
+    finally:
+        _password_pending -= 1
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run_password_job(pwd_context.hash, password)
+
+
+async def verify_and_update_password(password: str, hashed_password: str):
+    """Returns (valid, new_hash), new_hash is set when the stored hash is outdated"""
+    return await _run_password_job(
+        pwd_context.verify_and_update, password, hashed_password
+    )
+
+
+def _encode_token(data: dict, expire: datetime, token_type: str) -> str:
     to_encode = data.copy()
+    to_encode.update(
+        {"exp": expire, "token_type": token_type, "jti": uuid.uuid4().hex}
+    )  # Add token type and an id used for revocation
+    return jwt.encode(
+        to_encode,
+        SIGNING_KEYS[ACTIVE_KID],
+        algorithm=ALGORITHM,
+        headers={"kid": ACTIVE_KID},
+    )
+
+
+def create_access_token(data: dict, expires_delta: timedelta = None):
     expire = datetime.now(tz=timezone.utc) + (
         expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     )
-    to_encode.update({"exp": expire, "token_type": "access_token"})  # Add token type
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return _encode_token(data, expire, "access_token")
 
 
 def create_refresh_token(data: dict, expires_delta: timedelta = None):
-    to_encode = data.copy()
     expire = datetime.now(tz=timezone.utc) + (
         expires_delta or timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES)
     )
-    to_encode.update({"exp": expire, "token_type": "refresh_token"})  # Add token type
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return _encode_token(data, expire, "refresh_token")
+
+
+def _token_cache_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
 
 
-def verify_token(token: str = Depends(oauth2_scheme)):
+def _prune_revoked(now) -> None:
+    """Forget expired revocations, called with _tokens_lock held"""
+    for jti, expire in list(_revoked_tokens.items()):
+        if expire <= now:
+            del _revoked_tokens[jti]
+
+
+def revoke_token(payload: dict) -> None:
+    """Reject the token from now on, remembered only until it would expire.
+
+    Revocations are shared with the other workers through the coordination
+    backend, which sync_revocations mirrors into memory.
+    """
+    now = time.time()
+    with _tokens_lock:
+        _prune_revoked(now)
+        if payload.get("jti"):
+            _revoked_tokens[payload["jti"]] = payload["exp"]
+
+    if payload.get("jti"):
+        CoordinationBackendInstance.set(
+            f"revoked:{payload['jti']}",
+            payload["exp"],
+            ttl=max(payload["exp"] - now, 1),
+        )
+
+
+def _load_revocations() -> dict:
+    return {
+        key.removeprefix("revoked:"): expire
+        for key, expire in CoordinationBackendInstance.items("revoked:").items()
+    }
+
+
+async def sync_revocations() -> None:
+    """Copy the revocations of every worker into memory until cancelled.
+
+    Requests only check the in-memory copy, so a token revoked by another
+    worker is accepted here for at most REVOCATION_SYNC_SECONDS.
+    """
+    while True:
+        try:
+            revoked = await run_catalog_io(_load_revocations)
+            now = time.time()
+            with _tokens_lock:
+                for jti, expire in revoked.items():
+                    # Entries written before the expiry was stored hold True
+                    if expire is True:
+                        expire = now + REFRESH_TOKEN_EXPIRE_MINUTES * 60
+                    _revoked_tokens[jti] = expire
+                _prune_revoked(now)
+        except Exception as error:
+            logging.error(f"Could not read revoked tokens: {error}")
+        await asyncio.sleep(REVOCATION_SYNC_SECONDS)
+
+
+def is_revoked(payload: dict) -> bool:
+    jti = payload.get("jti")
+    if not jti:
+        return False
+    with _tokens_lock:
+        return jti in _revoked_tokens
+
+
+def decode_token(token: str) -> dict:
+    """Verify the token signature and expiry, served from cache when possible.
+
+    Raises JWTError for invalid, expired, revoked or unknown-key tokens.
+    """
+    cache_key = _token_cache_key(token)
+    with _tokens_lock:
+        payload = _verified_tokens.get(cache_key)
+        if payload is not None and payload["exp"] > time.time():
+            _verified_tokens.move_to_end(cache_key)
+        else:
+            payload = None
+
+    if payload is None:
+        kid = jwt.get_unverified_header(token).get("kid", "default")
+        if kid not in SIGNING_KEYS:
+            raise JWTError("Unknown signing key")
+
+        payload = jwt.decode(token, SIGNING_KEYS[kid], algorithms=[ALGORITHM])
+        with _tokens_lock:
+            _verified_tokens[cache_key] = payload
+            while len(_verified_tokens) > TOKEN_CACHE_SIZE:
+                _verified_tokens.popitem(last=False)
+
+    if is_revoked(payload):
+        raise JWTError("Token has been revoked")
+    return payload
+
+
+def verify_token_payload(token: str = Depends(oauth2_scheme)) -> dict:
+    """Decode an access token and return its claims"""
     try:
         # Decode the token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         username: str = payload.get("sub")
         token_type: str = payload.get("token_type")
 
@@ -65,9 +251,13 @@ def verify_token(token: str = Depends(oauth2_scheme)):
                 detail="Invalid token",
             )
 
-        return username
+        return payload
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token has expired or is invalid",
         )
+
+
+def verify_token(payload: dict = Depends(verify_token_payload)):
+    return payload["sub"]
@@ -0,0 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import os
+
+# Threads encoding and writing exports, caps concurrent export I/O per worker
+EXPORT_IO_WORKERS = int(os.getenv("EXPORT_IO_WORKERS", 4))
+# Threads reading and writing the catalog and query files, kept apart from the
+# export threads so a large export never queues a catalog read behind it
+CATALOG_IO_WORKERS = int(os.getenv("CATALOG_IO_WORKERS", 2))
+# Threads for coordination backend calls made on every request, e.g. shared
+# rate limit buckets
+COORDINATION_IO_WORKERS = int(os.getenv("COORDINATION_IO_WORKERS", 2))
+
+_export_executor = ThreadPoolExecutor(
+    max_workers=EXPORT_IO_WORKERS, thread_name_prefix="export-io"
+)
+_catalog_executor = ThreadPoolExecutor(
+    max_workers=CATALOG_IO_WORKERS, thread_name_prefix="catalog-io"
+)
+_coordination_executor = ThreadPoolExecutor(
+    max_workers=COORDINATION_IO_WORKERS, thread_name_prefix="coordination-io"
+)
+
+
+async def _run(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # The thread can't be interrupted, let it finish before any cleanup
+        # touches the same files
+        await asyncio.wait([future])
+        raise
+
+
+async def run_export_io(func, *args, **kwargs):
+    """Run a blocking export call (encode, write, rename) off the event loop"""
+    return await _run(_export_executor, func, *args, **kwargs)
+
+
+async def run_catalog_io(func, *args, **kwargs):
+    """Run a blocking catalog or query file call off the event loop"""
+    return await _run(_catalog_executor, func, *args, **kwargs)
+
+
+async def run_coordination_io(func, *args, **kwargs):
+    """Run a blocking coordination backend call off the event loop"""
+    return await _run(_coordination_executor, func, *args, **kwargs)
+
+
+def read_text(path) -> str:
+    with open(path, "r") as file:
+        return file.read()
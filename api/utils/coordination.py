@@ -0,0 +1,257 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+# "sqlite" shares state between the workers on this host, "local" is per process
+COORDINATION_BACKEND = os.getenv("COORDINATION_BACKEND", "sqlite")
+COORDINATION_DB_PATH = os.getenv(
+    "COORDINATION_DB_PATH",
+    os.path.join(os.path.dirname(__file__), "../data/.coordination.sqlite3"),
+)
+# Token buckets kept by the local backend, the least recently used go first
+LOCAL_BUCKETS_MAX = 10000
+
+
+def refill_bucket(tokens, updated_at, now, rate, burst):
+    """Take a token from the bucket, returns (tokens left, seconds to wait).
+
+    The bucket holds up to burst tokens and refills at rate per second. A wait
+    above 0 means no token was taken.
+    """
+    if tokens is None:
+        tokens = burst
+    else:
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class CoordinationBackend(ABC):
+    """State shared by every worker: leases, and JSON values with an expiry.
+
+    A lease is held by one owner until released or its ttl runs out, so a
+    crashed worker never blocks the others for good.
+    """
+
+    @abstractmethod
+    def acquire(self, name, owner, ttl) -> bool:
+        """Take the lease, or extend it if owner already holds it"""
+
+    @abstractmethod
+    def release(self, name, owner) -> None:
+        """Give up the lease if owner holds it"""
+
+    @abstractmethod
+    def owner(self, name) -> str:
+        """Holder of the lease, None when it is free or expired"""
+
+    @abstractmethod
+    def get(self, key) -> Any:
+        """Value stored under key, None when unset or expired"""
+
+    @abstractmethod
+    def set(self, key, value, ttl=None) -> None:
+        """Store a JSON value, dropped after ttl seconds when given"""
+
+    @abstractmethod
+    def items(self, prefix) -> Dict[str, Any]:
+        """Unexpired values whose key starts with prefix"""
+
+    @abstractmethod
+    def take_token(self, key, rate, burst) -> float:
+        """Take a token from the bucket, returns 0 or the seconds until one is free"""
+
+
+class LocalBackend(CoordinationBackend):
+    def __init__(self) -> None:
+        self._leases = {}
+        self._values = {}
+        self._buckets = OrderedDict()
+
+    def acquire(self, name, owner, ttl) -> bool:
+        current = self._leases.get(name)
+        now = time.time()
+        if current is None or current[1] < now or current[0] == owner:
+            self._leases[name] = (owner, now + ttl)
+            return True
+        return False
+
+    def release(self, name, owner) -> None:
+        current = self._leases.get(name)
+        if current is not None and current[0] == owner:
+            del self._leases[name]
+
+    def owner(self, name) -> str:
+        current = self._leases.get(name)
+        if current is not None and current[1] >= time.time():
+            return current[0]
+        return None
+
+    def get(self, key) -> Any:
+        current = self._values.get(key)
+        if current is not None and (current[1] is None or current[1] >= time.time()):
+            return current[0]
+        return None
+
+    def set(self, key, value, ttl=None) -> None:
+        self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def items(self, prefix) -> Dict[str, Any]:
+        return {
+            key: self.get(key)
+            for key in list(self._values)
+            if key.startswith(prefix) and self.get(key) is not None
+        }
+
+    def take_token(self, key, rate, burst) -> float:
+        now = time.time()
+        tokens, updated_at = self._buckets.pop(key, (None, None))
+        tokens, wait = refill_bucket(tokens, updated_at, now, rate, burst)
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > LOCAL_BUCKETS_MAX:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteBackend(CoordinationBackend):
+    """Coordination through a WAL-mode SQLite file on local disk.
+
+    Every statement runs in autocommit mode, SQLite serialises the writers so
+    acquire is atomic across processes. The connection is opened per process,
+    so the backend is safe to create before workers fork.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def _execute(self, query, args=()):
+        with self._lock:
+            return self._connect().execute(query, args).fetchall()
+
+    def acquire(self, name, owner, ttl) -> bool:
+        now = time.time()
+        self._execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET "
+            "owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.expires_at < ? OR leases.owner = excluded.owner",
+            (name, owner, now + ttl, now),
+        )
+        return self.owner(name) == owner
+
+    def release(self, name, owner) -> None:
+        self._execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def owner(self, name) -> str:
+        rows = self._execute(
+            "SELECT owner FROM leases WHERE name = ? AND expires_at >= ?",
+            (name, time.time()),
+        )
+        return rows[0][0] if rows else None
+
+    def get(self, key) -> Any:
+        rows = self._execute(
+            "SELECT value FROM entries "
+            "WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (key, time.time()),
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    def set(self, key, value, ttl=None) -> None:
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value, default=str), now + ttl if ttl else None),
+        )
+
+        self._sweep(now)
+
+    def items(self, prefix) -> Dict[str, Any]:
+        rows = self._execute(
+            "SELECT key, value FROM entries WHERE substr(key, 1, ?) = ? "
+            "AND (expires_at IS NULL OR expires_at >= ?)",
+            (len(prefix), prefix, time.time()),
+        )
+        return {key: json.loads(value) for key, value in rows}
+
+    def take_token(self, key, rate, burst) -> float:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            # Read and update in one write transaction so no other worker
+            # spends the same token
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, wait = refill_bucket(*(row or (None, None)), now, rate, burst)
+                connection.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) "
+                    "VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        self._sweep(now)
+        return wait
+
+    def _sweep(self, now) -> None:
+        # Expired rows are only ignored by reads, sweep them now and then
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self._execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+            self._execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+            # Buckets idle for an hour have refilled, drop them
+            self._execute("DELETE FROM buckets WHERE updated_at < ?", (now - 3600,))
+
+
+def create_coordination_backend() -> CoordinationBackend:
+    if COORDINATION_BACKEND == "local":
+        return LocalBackend()
+    elif COORDINATION_BACKEND == "sqlite":
+        return SQLiteBackend(COORDINATION_DB_PATH)
+    raise ValueError(f"Unknown COORDINATION_BACKEND {COORDINATION_BACKEND}")
+
+
+CoordinationBackendInstance = create_coordination_backend()
@@ -0,0 +1,656 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+import csv
+import gzip
+import io
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+
+from utils.blocking_io import run_export_io
+from utils.export_store import ExportStoreInstance
+from utils.metrics import metrics
+
+# Rows fetched from the database and written to disk per round trip
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 10000))
+
+DEFAULT_EXPORT_FORMATS = ["csv"]
+
+# "native" encodes driver rows directly, "pandas" builds a DataFrame per chunk
+# first (slower, kept to compare output and for pandas specific formatting)
+EXPORT_ENGINE = os.getenv("EXPORT_ENGINE", "native")
+# Bytes buffered before plain CSV exports hit the disk
+EXPORT_WRITE_BUFFER = int(os.getenv("EXPORT_WRITE_BUFFER", 1024 * 1024))
+
+# Default size guards, catalog entries override them with "maxRows", "maxBytes"
+# and "spillRows". A refresh past maxRows rows or maxBytes bytes written is
+# aborted, 0 disables the cap. Bytes are counted once on disk, so the cap can
+# be overshot by up to EXPORT_WRITE_BUFFER per file. Keyed incremental merges
+# hold their delta in memory up to spillRows rows, then spill to a temp file.
+EXPORT_MAX_ROWS = int(os.getenv("EXPORT_MAX_ROWS", 0))
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", 0))
+EXPORT_SPILL_ROWS = int(os.getenv("EXPORT_SPILL_ROWS", 100000))
+
+# Rows buffered at most before the Arrow/Parquet schema is fixed, while some
+# column has held nothing but NULL
+EXPORT_SCHEMA_SAMPLE_ROWS = int(os.getenv("EXPORT_SCHEMA_SAMPLE_ROWS", 100000))
+# Decimal places kept at least for Arrow/Parquet decimal columns
+EXPORT_DECIMAL_SCALE = int(os.getenv("EXPORT_DECIMAL_SCALE", 9))
+
+# Content encodings written next to each CSV export (<name>.csv.gz/.csv.zst)
+# so downloads are never compressed on the fly. zstd needs zstandard installed.
+EXPORT_PRECOMPRESS = [
+    encoding.strip()
+    for encoding in os.getenv("EXPORT_PRECOMPRESS", "gzip").split(",")
+    if encoding.strip()
+]
+
+# Where the time of a refresh goes: query, fetch, encode, write and commit
+EXPORT_STAGE_SECONDS = metrics.histogram(
+    "export_stage_seconds", "Time spent per refresh export stage", ["stage"]
+)
+
+
+# Ranges of the pandas int64/uint64, datetime64[ns] and timedelta64[ns] dtypes,
+# values outside them make pandas fall back to object columns written with str()
+_INT_MIN = -(2**63)
+_INT_MAX = 2**64 - 1
+_DATETIME_MIN = datetime(1677, 9, 21, 0, 12, 43, 145225)
+_DATETIME_MAX = datetime(2262, 4, 11, 23, 47, 16, 854775)
+_TIMEDELTA_MAX = timedelta(microseconds=2**63 // 1000 - 1)
+
+
+def _format_timedelta(value, days_only) -> str:
+    if days_only:
+        return f"{value.days} days"
+    minutes, seconds = divmod(value.seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    text = f"{value.days} days {'+' if value.days < 0 else ''}"
+    text += f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return text + (f".{value.microseconds:06d}" if value.microseconds else "")
+
+
+def _format_column(column):
+    """Values of one chunk column as pandas would write them, None if unchanged.
+
+    Mirrors the dtype pandas infers for the column: ints next to NULLs become
+    float64, naive datetimes datetime64 and timedeltas timedelta64, which are
+    written differently from their str() form.
+    """
+    kinds = set(map(type, column))
+    if kinds & {type(None), float, Decimal}:
+        # NULL, NaN and Decimal NaN are all missing values to pandas
+        missing = [value is None or value != value for value in column]
+        values = [value for value, absent in zip(column, missing) if not absent]
+        kinds = set(map(type, values))
+    elif kinds & {datetime, timedelta}:
+        missing = [False] * len(column)
+        values = column
+    else:
+        return None
+    has_missing = len(values) < len(column)
+
+    def each(format_value):
+        return [
+            None if absent else format_value(value)
+            for value, absent in zip(column, missing)
+        ]
+
+    if (kinds <= {int, float} and has_missing) or kinds == {int, float}:
+        # Numbers pandas can't hold as int64/uint64 stay an object column
+        if all(_INT_MIN <= value <= _INT_MAX for value in values):
+            return each(float)
+    elif kinds == {datetime} and all(value.tzinfo is None for value in values):
+        if _DATETIME_MIN <= min(values) and max(values) <= _DATETIME_MAX:
+            if not any(
+                value.hour or value.minute or value.second or value.microsecond
+                for value in values
+            ):
+                return each(datetime.date)
+            if any(value.microsecond for value in values):
+                return each(lambda value: f"{value:%Y-%m-%d %H:%M:%S.%f}")
+    elif kinds == {timedelta}:
+        if all(abs(value) <= _TIMEDELTA_MAX for value in values):
+            days_only = not any(value.seconds or value.microseconds for value in values)
+            return each(lambda value: _format_timedelta(value, days_only))
+
+    return each(lambda value: value) if has_missing else None
+
+
+class _CsvEncoder:
+    """Write rows the way DataFrame.to_csv(index=False) does.
+
+    Each chunk column is formatted for the dtype pandas would give it: NULL,
+    NaN and Decimal NaN become empty fields, ints in a column with NULLs are
+    written as floats (1.0), naive datetimes all at midnight as dates, and with
+    microseconds on any value as .ffffff on every value. Timedeltas use pandas'
+    "1 days 02:00:00" form, anything else its str() form, so the output does
+    not depend on EXPORT_ENGINE.
+
+    As with the pandas engine the dtype is decided per chunk of
+    EXPORT_CHUNK_SIZE rows, not over the whole result as a single DataFrame
+    would: an int column gets floats only in the chunks holding a NULL, and
+    dates or microseconds only where every value, or any value, of that chunk
+    qualifies.
+    """
+
+    def __init__(self, file, columns, header=True):
+        self._file = file
+        self.columns = columns
+        self._header = header
+        self._writer = csv.writer(file, lineterminator=os.linesep)
+
+    def write_chunk(self, rows) -> None:
+        if EXPORT_ENGINE == "pandas":
+            self._write_dataframe(rows)
+            return
+
+        with EXPORT_STAGE_SECONDS.time(stage="encode"):
+            columns = list(zip(*rows))
+            formatted = [_format_column(column) for column in columns]
+            if any(column is not None for column in formatted):
+                rows = zip(
+                    *(
+                        column if column is not None else columns[index]
+                        for index, column in enumerate(formatted)
+                    )
+                )
+        with EXPORT_STAGE_SECONDS.time(stage="write"):
+            if self._header:
+                self._writer.writerow(self.columns)
+                self._header = False
+            self._writer.writerows(rows)
+
+    def _write_dataframe(self, rows) -> None:
+        import pandas as pd
+
+        with EXPORT_STAGE_SECONDS.time(stage="encode"):
+            dataframe = pd.DataFrame(rows, columns=self.columns)
+        with EXPORT_STAGE_SECONDS.time(stage="write"):
+            dataframe.to_csv(self._file, header=self._header, index=False)
+        self._header = False
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class _ArrowEncoder:
+    """Encode chunks as Arrow record batches.
+
+    Chunks are buffered until every column has held a value, or
+    EXPORT_SCHEMA_SAMPLE_ROWS rows, and the schema is unified across them:
+    NULL-only leading chunks, ints next to floats and decimals of different
+    scales all end up in one type. Decimals get at least EXPORT_DECIMAL_SCALE
+    places and columns still all NULL by then are written as strings. Later
+    chunks are cast to that schema only when no value changes, anything else
+    fails the export instead of writing wrong data.
+    """
+
+    def __init__(self, path, columns, open_writer):
+        self.path = path
+        self.columns = columns
+        self._open_writer = open_writer
+        self._writer = None
+        self._schema = None
+        self._buffer = []
+        self._buffered = 0
+
+    def write_chunk(self, rows) -> None:
+        import pyarrow as pa
+
+        with EXPORT_STAGE_SECONDS.time(stage="encode"):
+            if EXPORT_ENGINE == "pandas":
+                import pandas as pd
+
+                table = pa.Table.from_pandas(
+                    pd.DataFrame(rows, columns=self.columns), preserve_index=False
+                )
+            else:
+                table = self._to_table(pa, rows)
+
+        if self._schema is not None:
+            self._write(self._conform(pa, table))
+            return
+
+        self._buffer.append(table)
+        self._buffered += table.num_rows
+        if self._buffered >= EXPORT_SCHEMA_SAMPLE_ROWS or not any(
+            pa.types.is_null(field.type) for field in self._sample_schema(pa)
+        ):
+            self._flush_buffer(pa)
+
+    def _to_table(self, pa, rows):
+        values = list(zip(*rows)) if rows else [[] for _ in self.columns]
+        arrays = [pa.array(column) for column in values]
+        return pa.Table.from_arrays(arrays, names=self.columns)
+
+    def _sample_schema(self, pa):
+        return pa.unify_schemas(
+            [table.schema for table in self._buffer], promote_options="permissive"
+        )
+
+    def _flush_buffer(self, pa) -> None:
+        self._schema = pa.schema(
+            [self._widen(pa, field) for field in self._sample_schema(pa)]
+        )
+        for table in self._buffer:
+            self._write(self._conform(pa, table))
+        self._buffer = []
+
+    def _widen(self, pa, field):
+        if pa.types.is_null(field.type):
+            return field.with_type(pa.string())
+        if pa.types.is_decimal(field.type):
+            # Room for more scale than the sample had, numeric columns without
+            # a declared scale vary from row to row
+            digits = field.type.precision - field.type.scale
+            scale = max(field.type.scale, min(EXPORT_DECIMAL_SCALE, 38 - digits))
+            return field.with_type(pa.decimal128(38, scale))
+        return field
+
+    def _conform(self, pa, table):
+        arrays = []
+        for field, column in zip(self._schema, table.columns):
+            if column.type != field.type:
+                try:
+                    column = column.cast(field.type, safe=True)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as error:
+                    raise ValueError(
+                        f"Column {field.name} is {field.type} but a later chunk "
+                        f"holds {column.type}: {error}"
+                    ) from error
+            arrays.append(column)
+        return pa.Table.from_arrays(arrays, schema=self._schema)
+
+    def _write(self, table) -> None:
+        with EXPORT_STAGE_SECONDS.time(stage="write"):
+            if self._writer is None:
+                self._writer = self._open_writer(self.path, self._schema)
+            self._writer.write_table(table)
+
+    def close(self) -> None:
+        if self._schema is None and self._buffer:
+            import pyarrow as pa
+
+            self._flush_buffer(pa)
+        if self._writer is not None:
+            self._writer.close()
+
+
+class CsvFormat:
+    name = "csv"
+    extension = ".csv"
+    media_type = "text/csv"
+    appendable = True
+    # Content-Encoding -> format holding the same bytes compressed that way
+    precompressed = {"gzip": "csv.gz", "zstd": "csv.zst"}
+
+    def open_text(self, path, mode):
+        return open(path, mode, newline="", buffering=EXPORT_WRITE_BUFFER)
+
+    def open(self, path, columns, append=False):
+        if append:
+            return _CsvEncoder(self.open_text(path, "a"), columns, header=False)
+        return _CsvEncoder(self.open_text(path, "w"), columns)
+
+
+class GzipCsvFormat(CsvFormat):
+    name = "csv.gz"
+    extension = ".csv.gz"
+    media_type = "application/gzip"
+    precompressed = {}
+
+    def open_text(self, path, mode):
+        if mode == "r":
+            return gzip.open(path, "rt", newline="")
+
+        # Appending adds a new gzip member, readers decompress them as one
+        # stream. No name or timestamp in the header so equal rows compress to
+        # equal bytes and the export store can tell nothing changed.
+        raw = open(path, mode + "b")
+        compressed = gzip.GzipFile(filename="", mode=mode + "b", fileobj=raw, mtime=0)
+        compressed.myfileobj = raw  # closed along with the gzip stream
+        return io.TextIOWrapper(compressed, newline="")
+
+
+class ZstdCsvFormat(CsvFormat):
+    name = "csv.zst"
+    extension = ".csv.zst"
+    media_type = "application/zstd"
+    precompressed = {}
+
+    def open_text(self, path, mode):
+        import zstandard
+
+        # Appending adds a new zstd frame, read back across all of them
+        if mode == "r":
+            raw = zstandard.ZstdDecompressor().stream_reader(
+                open(path, "rb"), read_across_frames=True, closefd=True
+            )
+        else:
+            raw = zstandard.ZstdCompressor().stream_writer(
+                open(path, mode + "b"), closefd=True
+            )
+        return io.TextIOWrapper(raw, newline="")
+
+
+class ParquetFormat:
+    name = "parquet"
+    extension = ".parquet"
+    media_type = "application/vnd.apache.parquet"
+    appendable = False
+    precompressed = {}
+
+    def open(self, path, columns):
+        import pyarrow.parquet as pq
+
+        return _ArrowEncoder(path, columns, pq.ParquetWriter)
+
+
+class ArrowFormat:
+    name = "arrow"
+    extension = ".arrow"
+    media_type = "application/vnd.apache.arrow.file"
+    appendable = False
+    precompressed = {}
+
+    def open(self, path, columns):
+        import pyarrow as pa
+
+        return _ArrowEncoder(path, columns, pa.ipc.new_file)
+
+
+EXPORT_FORMATS = {
+    export_format.name: export_format
+    for export_format in (
+        CsvFormat(),
+        GzipCsvFormat(),
+        ZstdCsvFormat(),
+        ParquetFormat(),
+        ArrowFormat(),
+    )
+}
+
+
+def get_export_format(name):
+    """Look up an export format by name (csv, csv.gz, csv.zst, parquet, arrow)"""
+    try:
+        return EXPORT_FORMATS[name.lower()]
+    except KeyError:
+        raise ValueError(
+            f"Unknown export format {name}, expected one of {list(EXPORT_FORMATS)}"
+        )
+
+
+def with_precompressed(formats):
+    """Add the precompressed siblings configured in EXPORT_PRECOMPRESS"""
+    expanded = list(formats or DEFAULT_EXPORT_FORMATS)
+    for name in list(expanded):
+        precompressed = get_export_format(name).precompressed
+        for encoding in EXPORT_PRECOMPRESS:
+            sibling = precompressed.get(encoding)
+            if sibling is None or sibling in expanded:
+                continue
+            if encoding == "zstd" and not _zstandard_available():
+                logging.warning("zstandard is not installed, skipping .zst exports")
+                continue
+            expanded.append(sibling)
+    return expanded
+
+
+def _zstandard_available() -> bool:
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+
+class ExportLimitExceeded(Exception):
+    """The export passed its maxRows or maxBytes cap and was aborted"""
+
+
+class ExportWriter:
+    """Write query results to data/<filename>.<ext> one chunk at a time.
+
+    Every requested format is encoded from the same chunks. Each goes to a temp
+    file next to the target which is committed to the ExportStore only once
+    every chunk has been written, so readers never see a partial file.
+
+    With an incremental config ({"column", "key", "watermark"}) the writer
+    tracks the largest value of the watermark column. When a watermark is set
+    the chunks are a delta: they are appended to a copy of the existing export,
+    or merged into it replacing rows with the same key column value.
+
+    limits ({"maxRows", "maxBytes", "spillRows"}) override the EXPORT_MAX_*
+    and EXPORT_SPILL_ROWS defaults. Passing a cap raises ExportLimitExceeded
+    from write_chunk, the caller's exit then deletes the temp files.
+
+    Used with async with, chunks go through write() and the final rename or
+    cleanup also run on the export I/O threads instead of the event loop.
+    """
+
+    def __init__(
+        self, path, filename, columns, formats=None, incremental=None, limits=None
+    ):
+        self.columns = columns
+        self.rows = 0
+        self.bytes = 0
+        self.changed = False
+        self.watermark = None
+        self._targets = []
+        self._encoders = []
+        self._pending = []
+        self._spill = None
+        self._delta_keys = set()
+        self._path = path
+
+        limits = limits or {}
+        self.max_rows = limits.get("maxRows", EXPORT_MAX_ROWS)
+        self.max_bytes = limits.get("maxBytes", EXPORT_MAX_BYTES)
+        self.spill_rows = limits.get("spillRows", EXPORT_SPILL_ROWS)
+        for name in with_precompressed(formats):
+            export_format = get_export_format(name)
+            target = os.path.join(path, filename + export_format.extension)
+            self._targets.append((export_format, target, target + ".tmp"))
+
+        incremental = incremental or {}
+        self._watermark_index = None
+        if incremental.get("column"):
+            self._watermark_index = columns.index(incremental["column"])
+            self.watermark = incremental.get("watermark")
+
+        self._delta = incremental.get("watermark") is not None
+        self._merge_key = incremental.get("key") if self._delta else None
+        if self._delta and not all(
+            export_format.appendable for export_format, _, _ in self._targets
+        ):
+            raise ValueError("Incremental exports support csv and csv.gz formats only")
+
+    @property
+    def paths(self):
+        return [target for _, target, _ in self._targets]
+
+    def result(self) -> dict:
+        """Rows and bytes written, whether any file changed and the new watermark"""
+        return {
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "changed": self.changed,
+            "watermark": self.watermark,
+        }
+
+    def write_chunk(self, rows) -> None:
+        self._track_watermark(rows)
+        self.rows += len(rows)
+        if self.max_rows and self.rows > self.max_rows:
+            raise ExportLimitExceeded(
+                f"Export passed its limit of {self.max_rows} rows"
+            )
+
+        if self._merge_key:
+            # Merging needs every delta key before the old rows can be filtered
+            key_index = self.columns.index(self._merge_key)
+            self._delta_keys.update(str(row[key_index]) for row in rows)
+            self._pending.extend(rows)
+            if len(self._pending) >= self.spill_rows:
+                self._spill_pending()
+            self._check_bytes()
+            return
+
+        if not self._encoders:
+            self._encoders = [
+                self._open_encoder(export_format, target, tmp_path)
+                for export_format, target, tmp_path in self._targets
+            ]
+
+        for encoder in self._encoders:
+            encoder.write_chunk(rows)
+        self._check_bytes()
+
+    def _check_bytes(self) -> None:
+        if not self.max_bytes:
+            return
+
+        written = sum(
+            os.path.getsize(tmp_path)
+            for _, _, tmp_path in self._targets
+            if os.path.exists(tmp_path)
+        )
+        if self._spill is not None:
+            written += self._spill.tell()
+        if written > self.max_bytes:
+            raise ExportLimitExceeded(
+                f"Export passed its limit of {self.max_bytes} bytes"
+            )
+
+    def _spill_pending(self) -> None:
+        """Move the buffered delta rows to a temp file, deleted once closed"""
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(dir=self._path, suffix=".spill")
+            logging.info(f"Spilling merge rows of {', '.join(self.paths)} to disk")
+        # Driver records may not pickle, plain tuples always do
+        pickle.dump(
+            [tuple(row) for row in self._pending],
+            self._spill,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        self._pending = []
+
+    def _pending_chunks(self):
+        """The delta rows, spilled chunks first"""
+        if self._spill is not None:
+            self._spill.seek(0)
+            while True:
+                try:
+                    yield pickle.load(self._spill)
+                except EOFError:
+                    break
+        if self._pending:
+            yield self._pending
+
+    def _open_encoder(self, export_format, target, tmp_path):
+        if self._delta:
+            shutil.copyfile(target, tmp_path)
+            return export_format.open(tmp_path, self.columns, append=True)
+        return export_format.open(tmp_path, self.columns)
+
+    def _track_watermark(self, rows) -> None:
+        if self._watermark_index is None:
+            return
+
+        values = [
+            row[self._watermark_index]
+            for row in rows
+            if row[self._watermark_index] is not None
+        ]
+        if values:
+            chunk_max = max(values)
+            if self.watermark is None or chunk_max > self.watermark:
+                self.watermark = chunk_max
+
+    def _merge(self, export_format, target, tmp_path) -> None:
+        """Copy the rows of the old export whose key is not in the delta"""
+        delta_keys = self._delta_keys
+        with export_format.open_text(target, "r") as old_file:
+            with export_format.open_text(tmp_path, "w") as new_file:
+                reader = csv.reader(old_file)
+                writer = csv.writer(new_file, lineterminator=os.linesep)
+                header = next(reader)
+                writer.writerow(header)
+                old_key_index = header.index(self._merge_key)
+                for index, row in enumerate(reader, 1):
+                    if row[old_key_index] not in delta_keys:
+                        writer.writerow(row)
+                    if index % EXPORT_CHUNK_SIZE == 0:
+                        self._check_bytes()
+
+        encoder = export_format.open(tmp_path, self.columns, append=True)
+        self._encoders.append(encoder)
+        for rows in self._pending_chunks():
+            encoder.write_chunk(rows)
+            self._check_bytes()
+
+    def _close_spill(self) -> None:
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def close(self) -> None:
+        if self._pending or self._spill is not None:
+            try:
+                for export_format, target, tmp_path in self._targets:
+                    self._merge(export_format, target, tmp_path)
+            except BaseException:
+                self.abort()
+                raise
+            self._pending = []
+            self._close_spill()
+
+        if not self._encoders:
+            return
+        with EXPORT_STAGE_SECONDS.time(stage="commit"):
+            for encoder in self._encoders:
+                encoder.close()
+            for _, target, tmp_path in self._targets:
+                self.bytes += os.path.getsize(tmp_path)
+                if ExportStoreInstance.commit(tmp_path, target):
+                    self.changed = True
+        if self.changed:
+            print(f"{self.rows} rows saved to {', '.join(self.paths)}")
+        else:
+            print(f"{self.rows} rows unchanged in {', '.join(self.paths)}")
+
+    def abort(self) -> None:
+        self._close_spill()
+        for encoder in self._encoders:
+            try:
+                encoder.close()
+            except Exception as error:
+                print(f"Error closing export encoder: {error}")
+        for _, _, tmp_path in self._targets:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    async def write(self, rows) -> None:
+        await run_export_io(self.write_chunk, rows)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await run_export_io(self.close)
+        else:
+            await run_export_io(self.abort)
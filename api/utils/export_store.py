@@ -0,0 +1,186 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+# Versions of each export kept for rollback, older blobs are deleted
+EXPORT_VERSIONS = int(os.getenv("EXPORT_VERSIONS", 5))
+
+STORE_DIRECTORY = ".exports"
+
+
+def _file_digest(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ExportStore:
+    """Content-addressed storage behind data/<name>.<ext>.
+
+    Each export is stored once as data/.exports/blobs/<sha256><ext> and
+    data/<name>.<ext> is a hard link to the current blob, swapped in with
+    os.replace. Readers open the path as before and always get a complete file,
+    exports with identical content share one blob, and an export whose hash
+    matches the current one leaves the file untouched.
+
+    data/.exports/versions/<name>.<ext>.json lists the last EXPORT_VERSIONS
+    hashes, newest first, for rollback. Shared blobs keep their mtime, the
+    version file records when each name last changed (pointedAt) and caches
+    use that through modified_ns. Version files and blob cleanup are
+    guarded by an flock so worker processes can commit concurrently.
+    """
+
+    def __init__(self, versions=EXPORT_VERSIONS) -> None:
+        self.versions_kept = versions
+
+    def _root(self, target) -> str:
+        return os.path.join(os.path.dirname(target), STORE_DIRECTORY)
+
+    def _blob_path(self, target, digest) -> str:
+        extension = os.path.basename(target).partition(".")[2]
+        return os.path.join(self._root(target), "blobs", f"{digest}.{extension}")
+
+    def _versions_path(self, target) -> str:
+        return os.path.join(
+            self._root(target), "versions", os.path.basename(target) + ".json"
+        )
+
+    @contextmanager
+    def _lock(self, target):
+        root = self._root(target)
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(root, "versions"), exist_ok=True)
+        with open(os.path.join(root, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def versions(self, target) -> List[Dict]:
+        try:
+            with open(self._versions_path(target), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return []
+
+    def _write_versions(self, target, versions) -> None:
+        path = self._versions_path(target)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(versions, file, indent=4)
+        os.replace(tmp_path, path)
+
+    def pointer(self, target) -> Dict:
+        """Version data/<name>.<ext> points to, None if not stored"""
+        versions = self.versions(target)
+        if not versions or not os.path.exists(target):
+            return None
+        blob = self._blob_path(target, versions[0]["hash"])
+        if os.path.exists(blob) and os.path.samefile(blob, target):
+            return versions[0]
+        return None
+
+    def current(self, target) -> str:
+        """Hash of the blob data/<name>.<ext> points to, None if not stored"""
+        pointer = self.pointer(target)
+        return pointer["hash"] if pointer else None
+
+    def modified_ns(self, target) -> int:
+        """When target last changed, its own mtime if it is not stored"""
+        pointer = self.pointer(target)
+        if pointer and "pointedAt" in pointer:
+            return pointer["pointedAt"]
+        return os.stat(target).st_mtime_ns
+
+    def commit(self, tmp_path, target) -> bool:
+        """Store the written file and point target at it, False if unchanged"""
+        digest = _file_digest(tmp_path)
+        with self._lock(target):
+            if digest == self.current(target):
+                os.remove(tmp_path)
+                return False
+
+            blob = self._blob_path(target, digest)
+            if os.path.exists(blob):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, blob)
+            self._point(target, blob)
+
+            versions = [
+                version
+                for version in self.versions(target)
+                if version["hash"] != digest
+            ]
+            versions.insert(
+                0,
+                {
+                    "hash": digest,
+                    "bytes": os.path.getsize(blob),
+                    "createdAt": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "pointedAt": time.time_ns(),
+                },
+            )
+            self._write_versions(target, versions[: self.versions_kept])
+            for version in versions[self.versions_kept :]:
+                self._collect(target, version["hash"])
+        return True
+
+    def rollback(self, target, digest) -> bool:
+        """Point target back at one of its kept versions"""
+        with self._lock(target):
+            versions = self.versions(target)
+            for index, version in enumerate(versions):
+                if version["hash"] == digest:
+                    break
+            else:
+                return False
+
+            blob = self._blob_path(target, digest)
+            if not os.path.exists(blob):
+                return False
+            self._point(target, blob)
+            versions[index]["pointedAt"] = time.time_ns()
+            versions.insert(0, versions.pop(index))
+            self._write_versions(target, versions)
+        return True
+
+    def _point(self, target, blob) -> None:
+        link_path = target + ".link"
+        if os.path.exists(link_path):
+            os.remove(link_path)
+        try:
+            os.link(blob, link_path)
+        except OSError:
+            # No hard links on this filesystem, fall back to a copy
+            shutil.copyfile(blob, link_path)
+        os.replace(link_path, target)
+
+    def _collect(self, target, digest) -> None:
+        """Delete a blob no longer listed in any versions file"""
+        versions_directory = os.path.dirname(self._versions_path(target))
+        for entry in os.listdir(versions_directory):
+            if not entry.endswith(".json"):
+                continue
+            with open(os.path.join(versions_directory, entry), "r") as file:
+                if any(version["hash"] == digest for version in json.load(file)):
+                    return
+
+        blob = self._blob_path(target, digest)
+        if os.path.exists(blob):
+            logging.info(f"Removing unused export blob {blob}")
+            os.remove(blob)
+
+
+ExportStoreInstance = ExportStore()
@@ -0,0 +1,65 @@
+from contextlib import asynccontextmanager
+from typing import Dict
+import asyncio
+import time
+
+from utils.metrics import metrics
+
+POOL_WAIT_SECONDS = metrics.histogram(
+    "db_pool_wait_seconds",
+    "Time spent waiting for a pooled database connection",
+    ["database"],
+)
+POOL_TIMEOUTS = metrics.counter(
+    "db_pool_timeouts_total",
+    "Connection acquires that timed out",
+    ["database"],
+)
+
+
+class PoolStats:
+    """Counters for connection pool acquires, how long they waited and timeouts"""
+
+    def __init__(self, database: str) -> None:
+        self.database = database
+        self.acquired = 0
+        self.in_use = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    @asynccontextmanager
+    async def track(self, acquire):
+        """Time the acquire and count the connection as in use until released"""
+        started = time.perf_counter()
+        acquired = False
+        try:
+            async with acquire as connection:
+                acquired = True
+                waited = time.perf_counter() - started
+                self.acquired += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+                self.in_use += 1
+                POOL_WAIT_SECONDS.observe(waited, database=self.database)
+                try:
+                    yield connection
+                finally:
+                    self.in_use -= 1
+        except asyncio.TimeoutError:
+            if not acquired:
+                self.timeouts += 1
+                POOL_TIMEOUTS.inc(database=self.database)
+            raise
+
+    def to_dict(self) -> Dict:
+        return {
+            "inUse": self.in_use,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "waitSecondsTotal": self.wait_seconds_total,
+            "waitSecondsMax": self.wait_seconds_max,
+            "waitSecondsAvg": (
+                self.wait_seconds_total / self.acquired if self.acquired else 0.0
+            ),
+        }
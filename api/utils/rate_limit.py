@@ -0,0 +1,144 @@
+from fastapi import Depends, HTTPException, Request, status
+from utils.auth_utils import verify_token_payload
+from utils.blocking_io import run_coordination_io
+from utils.coordination import LocalBackend, CoordinationBackendInstance
+from utils.metrics import metrics
+import ipaddress
+import logging
+import math
+import os
+
+logging.basicConfig(level=logging.INFO)
+
+
+def _parse_limit(value):
+    """Parse "<requests per second>,<burst>", None when empty"""
+    if not value:
+        return None
+    rate, _, burst = value.partition(",")
+    rate = float(rate)
+    return rate, float(burst or max(1, rate))
+
+
+# Token buckets per principal and route group, "<per second>,<burst>", empty
+# disables the limit. Login is keyed by client address as there is no
+# principal yet, everything else by the token's user.
+RATE_LIMITS = {
+    "login": _parse_limit(os.getenv("RATE_LIMIT_LOGIN", "0.5,10")),
+    "download": _parse_limit(os.getenv("RATE_LIMIT_DOWNLOAD", "5,20")),
+    "refresh": _parse_limit(os.getenv("RATE_LIMIT_REFRESH", "0.2,10")),
+    "api": _parse_limit(os.getenv("RATE_LIMIT_API", "20,100")),
+}
+# "local" keeps buckets in each worker and splits every limit evenly between
+# the API_WORKERS workers. That is exact only as far as the kernel spreads a
+# client's connections evenly. "coordination" shares the buckets through
+# COORDINATION_BACKEND, one write per request on the coordination threads.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "local")
+API_WORKERS = int(os.getenv("API_WORKERS", 1))
+# Reverse proxies, "10.0.0.1,10.1.0.0/16", whose X-Forwarded-For header names
+# the client. Without them a proxy or NAT puts every user in one login bucket.
+RATE_LIMIT_TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "").split(",")
+    if entry.strip()
+]
+
+RATE_LIMITED = metrics.counter(
+    "rate_limited_total", "Requests refused by a rate limit", ["group"]
+)
+
+
+class RateLimiter:
+    """Token buckets per route group and principal, stored in a coordination
+    backend so they can be kept per worker or shared between workers.
+    """
+
+    def __init__(self, backend, limits, shared=True) -> None:
+        self.backend = backend
+        self.limits = limits
+        self.shared = shared
+
+    async def check(self, group, principal) -> None:
+        """Take a token, raises a 429 with Retry-After when there is none"""
+        limit = self.limits.get(group)
+        if limit is None:
+            return
+
+        rate, burst = limit
+        key = f"rate:{group}:{principal}"
+        if self.shared:
+            wait = await run_coordination_io(self.backend.take_token, key, rate, burst)
+        else:
+            wait = self.backend.take_token(key, rate, burst)
+
+        if wait > 0:
+            RATE_LIMITED.inc(group=group)
+            logging.info(f"Rate limited {principal} on {group}")
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, try again later",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+
+
+def _per_worker(limit, workers):
+    if limit is None:
+        return None
+    rate, burst = limit
+    return rate / workers, max(1, burst / workers)
+
+
+def create_rate_limiter() -> RateLimiter:
+    if RATE_LIMIT_BACKEND == "local":
+        limits = {
+            group: _per_worker(limit, API_WORKERS)
+            for group, limit in RATE_LIMITS.items()
+        }
+        return RateLimiter(LocalBackend(), limits, shared=False)
+    elif RATE_LIMIT_BACKEND == "coordination":
+        return RateLimiter(CoordinationBackendInstance, RATE_LIMITS)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND {RATE_LIMIT_BACKEND}")
+
+
+RateLimiterInstance = create_rate_limiter()
+
+
+def _trusted(address) -> bool:
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in RATE_LIMIT_TRUSTED_PROXIES)
+
+
+def client_address(request: Request) -> str:
+    """Address of the client, as reported by trusted proxies in front of us"""
+    address = request.client.host if request.client else "unknown"
+    if not _trusted(address):
+        return address
+
+    # Each proxy appends the address it got the request from, the rightmost
+    # one not added by a trusted proxy is the client
+    forwarded = request.headers.get("x-forwarded-for", "").split(",")
+    for hop in reversed([hop.strip() for hop in forwarded if hop.strip()]):
+        if not _trusted(hop):
+            return hop
+    return address
+
+
+def rate_limit(group):
+    """Dependency limiting the route per authenticated user"""
+
+    async def dependency(payload: dict = Depends(verify_token_payload)) -> None:
+        await RateLimiterInstance.check(group, payload["sub"])
+
+    return dependency
+
+
+def rate_limit_by_client(group):
+    """Dependency limiting the route per client address, for unauthenticated routes"""
+
+    async def dependency(request: Request) -> None:
+        await RateLimiterInstance.check(group, client_address(request))
+
+    return dependency
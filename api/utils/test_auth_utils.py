@@ -0,0 +1,37 @@
+from collections import OrderedDict
+import threading
+
+from utils import auth_utils
+
+
+class RacingCache(OrderedDict):
+    """Token cache that lets another request run right after each lookup"""
+
+    other_request = None
+
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        if value is not None and self.other_request is not None:
+            other = threading.Thread(target=self.other_request)
+            self.other_request = None
+            other.start()
+            # Long enough for it to finish unless it waits on this lookup
+            other.join(0.2)
+            self.other = other
+        return value
+
+
+def test_eviction_during_a_cached_decode(monkeypatch):
+    first = auth_utils.create_access_token({"sub": "first"})
+    second = auth_utils.create_access_token({"sub": "second"})
+    cache = RacingCache()
+    monkeypatch.setattr(auth_utils, "_verified_tokens", cache)
+    auth_utils.decode_token(first)
+
+    # Decoding the second token evicts the first one from the cache
+    monkeypatch.setattr(auth_utils, "TOKEN_CACHE_SIZE", 1)
+    cache.other_request = lambda: auth_utils.decode_token(second)
+
+    assert auth_utils.decode_token(first)["sub"] == "first"
+    cache.other.join()
+    assert len(cache) == 1
@@ -0,0 +1,12 @@
+import pytest
+
+from utils.coordination import CoordinationBackend, LocalBackend
+
+
+def test_backend_missing_a_method_fails_when_created():
+    class NoTokens(CoordinationBackend):
+        acquire = release = owner = get = set = items = LocalBackend.get
+
+    with pytest.raises(TypeError, match="take_token"):
+        NoTokens()
+
@@ -0,0 +1,172 @@
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+import csv
+import os
+
+import pytest
+
+from utils.export_formats import ExportLimitExceeded, ExportWriter
+
+COLUMNS = ["id", "name", "version"]
+
+
+def export(path, rows, formats=("csv",), incremental=None, limits=None):
+    with ExportWriter(
+        str(path), "stations", COLUMNS, list(formats), incremental, limits
+    ) as writer:
+        for start in range(0, len(rows), 2):
+            writer.write_chunk(rows[start : start + 2])
+    return writer
+
+
+def read_csv(path):
+    with open(path / "stations.csv", newline="") as file:
+        return list(csv.reader(file))
+
+
+def leftovers(path):
+    return [name for name in os.listdir(path) if name.endswith((".tmp", ".spill"))]
+
+
+def test_full_export_is_committed_once_per_content(tmp_path):
+    rows = [(1, "a", 1), (2, "b", 1), (3, "c", 1)]
+
+    assert export(tmp_path, rows).result()["changed"]
+    assert read_csv(tmp_path) == [COLUMNS] + [[str(v) for v in row] for row in rows]
+
+    unchanged = export(tmp_path, rows).result()
+    assert unchanged["rows"] == 3
+    assert not unchanged["changed"]
+    assert leftovers(tmp_path) == []
+
+
+def test_delta_without_key_is_appended(tmp_path):
+    export(tmp_path, [(1, "a", 1), (2, "b", 1)], incremental={"column": "id"})
+
+    writer = export(
+        tmp_path, [(3, "c", 1)], incremental={"column": "id", "watermark": 2}
+    )
+
+    assert writer.result()["watermark"] == 3
+    assert [row[0] for row in read_csv(tmp_path)[1:]] == ["1", "2", "3"]
+
+
+@pytest.mark.parametrize("spill_rows", [1, 100000])
+def test_delta_with_key_replaces_rows(tmp_path, spill_rows):
+    incremental = {"column": "version", "key": "id"}
+    export(tmp_path, [(1, "a", 1), (2, "b", 1), (3, "c", 1)], incremental=incremental)
+
+    # spillRows 1 moves every delta chunk to the spill file before the merge
+    export(
+        tmp_path,
+        [(2, "b2", 2), (4, "d", 2), (3, "c2", 2)],
+        incremental={**incremental, "watermark": 1},
+        limits={"spillRows": spill_rows},
+    )
+
+    assert read_csv(tmp_path)[1:] == [
+        ["1", "a", "1"],
+        ["2", "b2", "2"],
+        ["4", "d", "2"],
+        ["3", "c2", "2"],
+    ]
+    assert leftovers(tmp_path) == []
+
+
+def test_max_rows_aborts_and_keeps_the_old_export(tmp_path):
+    export(tmp_path, [(1, "a", 1)])
+
+    with pytest.raises(ExportLimitExceeded):
+        export(tmp_path, [(1, "a", 2), (2, "b", 2), (3, "c", 2)], limits={"maxRows": 2})
+
+    assert read_csv(tmp_path)[1:] == [["1", "a", "1"]]
+    assert leftovers(tmp_path) == []
+
+
+def test_max_bytes_is_enforced_while_merging(tmp_path):
+    incremental = {"column": "version", "key": "id"}
+    rows = [(index, "x" * 100, 1) for index in range(30000)]
+    export(tmp_path, rows, incremental=incremental)
+
+    with pytest.raises(ExportLimitExceeded):
+        export(
+            tmp_path,
+            [(0, "y", 2)],
+            incremental={**incremental, "watermark": 1},
+            limits={"maxBytes": 1024 * 1024},
+        )
+
+    assert len(read_csv(tmp_path)) == 30001
+    assert leftovers(tmp_path) == []
+
+
+def test_parquet_schema_is_not_fixed_by_the_first_chunk(tmp_path):
+    import pyarrow.parquet as pq
+
+    # The first chunk has no versions and integer ids, later ones add both
+    rows = [(1, "a", None), (2, "b", None), (3.5, "c", 7), (4, "d", 8)]
+    export(tmp_path, rows, formats=["parquet"])
+
+    table = pq.read_table(tmp_path / "stations.parquet")
+    assert str(table.schema.field("id").type) == "double"
+    assert str(table.schema.field("version").type) == "int64"
+    assert table.column("version").to_pylist() == [None, None, 7, 8]
+
+
+# Column values whose CSV form depends on the dtype pandas gives the column
+PANDAS_COLUMNS = {
+    "int_with_null": [1, None, 3],
+    "int_beyond_int64": [2**64, None],
+    "int_and_float": [1, 2.5],
+    "float_nan": [0.1, float("nan"), 1e16],
+    "datetime_midnight": [datetime(2024, 1, 1), None],
+    "datetime_microseconds": [
+        datetime(2024, 1, 1, 1, 2, 3, 5),
+        datetime(2024, 1, 1, 1, 2, 3),
+    ],
+    "datetime_seconds": [datetime(2024, 1, 1, 1, 2, 3), datetime(2024, 1, 1)],
+    "datetime_out_of_range": [datetime(1, 1, 1), None],
+    "datetime_aware": [
+        datetime(2024, 1, 1, tzinfo=timezone.utc),
+        datetime(2024, 1, 1, 1, 0, 0, 7, tzinfo=timezone.utc),
+    ],
+    "timedelta": [timedelta(hours=1), timedelta(days=2, microseconds=5), None],
+    "timedelta_negative": [timedelta(seconds=-1), timedelta(microseconds=-5)],
+    "timedelta_days": [timedelta(days=1), None],
+    "decimal_nan": [Decimal("1.50"), Decimal("NaN"), None],
+    "date": [date(2024, 1, 1), None],
+    "bool_with_null": [True, None],
+    "text_with_null": ["a", None],
+}
+
+
+@pytest.mark.parametrize("values", PANDAS_COLUMNS.values(), ids=PANDAS_COLUMNS)
+def test_csv_matches_pandas(tmp_path, values):
+    pd = pytest.importorskip("pandas")
+    rows = [(index, value) for index, value in enumerate(values)]
+
+    with ExportWriter(str(tmp_path), "types", ["id", "value"], ["csv"]) as writer:
+        writer.write_chunk(rows)
+
+    expected = pd.DataFrame(rows, columns=["id", "value"]).to_csv(index=False)
+    assert (tmp_path / "types.csv").read_text() == expected
+
+
+def test_csv_column_formats_are_decided_per_chunk(tmp_path):
+    rows = [
+        (1, "a", datetime(2024, 1, 1)),
+        (2, "b", datetime(2024, 1, 2)),
+        (3, "c", datetime(2024, 1, 3, 1, 2, 3, 5)),
+        (None, "d", datetime(2024, 1, 3, 1, 2, 3)),
+    ]
+
+    export(tmp_path, rows)
+
+    # The first chunk of two rows has no NULL id and only midnights, the
+    # second has both a NULL id and microseconds
+    assert read_csv(tmp_path)[1:] == [
+        ["1", "a", "2024-01-01"],
+        ["2", "b", "2024-01-02"],
+        ["3.0", "c", "2024-01-03 01:02:03.000005"],
+        ["", "d", "2024-01-03 01:02:03.000000"],
+    ]
@@ -0,0 +1,68 @@
+import os
+
+from utils.export_store import ExportStore
+
+
+def commit(store, path, name, content):
+    target = os.path.join(path, name)
+    with open(target + ".tmp", "w") as file:
+        file.write(content)
+    return store.commit(target + ".tmp", target)
+
+
+def read(path, name):
+    with open(os.path.join(path, name)) as file:
+        return file.read()
+
+
+def test_identical_content_is_not_committed_again(tmp_path):
+    store = ExportStore()
+
+    assert commit(store, tmp_path, "a.csv", "x\n1\n")
+    assert not commit(store, tmp_path, "a.csv", "x\n1\n")
+    assert len(store.versions(os.path.join(tmp_path, "a.csv"))) == 1
+    assert not os.path.exists(os.path.join(tmp_path, "a.csv.tmp"))
+
+
+def test_rollback_points_back_at_a_kept_version(tmp_path):
+    store = ExportStore()
+    target = os.path.join(tmp_path, "a.csv")
+    commit(store, tmp_path, "a.csv", "x\n1\n")
+    commit(store, tmp_path, "a.csv", "x\n2\n")
+    before = store.modified_ns(target)
+    previous = store.versions(target)[1]["hash"]
+
+    assert store.rollback(target, previous)
+
+    assert read(tmp_path, "a.csv") == "x\n1\n"
+    assert store.current(target) == previous
+    assert store.modified_ns(target) > before
+    assert not store.rollback(target, "0" * 64)
+
+
+def test_old_versions_are_collected(tmp_path):
+    store = ExportStore(versions=2)
+    target = os.path.join(tmp_path, "a.csv")
+    for value in range(3):
+        commit(store, tmp_path, "a.csv", f"x\n{value}\n")
+
+    blobs = os.listdir(os.path.join(tmp_path, ".exports", "blobs"))
+    assert sorted(blobs) == sorted(
+        f"{version['hash']}.csv" for version in store.versions(target)
+    )
+
+
+def test_names_sharing_a_blob_keep_their_own_version(tmp_path):
+    store = ExportStore()
+    commit(store, tmp_path, "a.csv", "x\n1\n")
+    blob_mtime = os.stat(os.path.join(tmp_path, "a.csv")).st_mtime_ns
+    a_version = store.modified_ns(os.path.join(tmp_path, "a.csv"))
+
+    commit(store, tmp_path, "b.csv", "x\n1\n")
+
+    assert os.path.samefile(
+        os.path.join(tmp_path, "a.csv"), os.path.join(tmp_path, "b.csv")
+    )
+    assert os.stat(os.path.join(tmp_path, "a.csv")).st_mtime_ns == blob_mtime
+    assert store.modified_ns(os.path.join(tmp_path, "a.csv")) == a_version
+    assert store.modified_ns(os.path.join(tmp_path, "b.csv")) > a_version
@@ -0,0 +1,91 @@
+import asyncio
+import ipaddress
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from utils.coordination import LocalBackend, SQLiteBackend, refill_bucket
+from utils.rate_limit import RateLimiter, _per_worker, client_address
+import utils.rate_limit
+
+
+def test_bucket_starts_full_and_refills_at_rate():
+    tokens, wait = refill_bucket(None, None, 100.0, rate=2, burst=3)
+    assert (tokens, wait) == (2, 0.0)
+
+    tokens, wait = refill_bucket(0.5, 100.0, 100.0, rate=2, burst=3)
+    assert (tokens, wait) == (0.5, 0.25)
+
+    # Never more than burst, however long the bucket sat idle
+    tokens, wait = refill_bucket(0, 100.0, 200.0, rate=2, burst=3)
+    assert (tokens, wait) == (2, 0.0)
+
+
+@pytest.fixture(params=["local", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "local":
+        return LocalBackend()
+    return SQLiteBackend(str(tmp_path / "coordination.sqlite3"))
+
+
+def test_backend_allows_the_burst_then_refuses(backend):
+    waits = [backend.take_token("rate:api:alice", 0.01, 3) for _ in range(4)]
+
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3] > 0
+    # Buckets are per key
+    assert backend.take_token("rate:api:bob", 0.01, 3) == 0.0
+
+
+@pytest.mark.parametrize("shared", [True, False])
+def test_limiter_raises_429_with_retry_after(shared):
+    limiter = RateLimiter(LocalBackend(), {"api": (0.5, 2), "login": None}, shared)
+
+    async def run():
+        await limiter.check("api", "alice")
+        await limiter.check("api", "alice")
+        for _ in range(5):
+            await limiter.check("login", "alice")
+        with pytest.raises(HTTPException) as error:
+            await limiter.check("api", "alice")
+        return error.value
+
+    error = asyncio.run(run())
+
+    assert error.status_code == 429
+    assert error.headers["Retry-After"] == "2"
+
+
+def test_local_limits_are_split_between_workers():
+    assert _per_worker((20, 100), 4) == (5, 25)
+    # Every worker lets at least one request through
+    assert _per_worker((0.5, 2), 4) == (0.125, 1)
+    assert _per_worker(None, 4) is None
+
+
+def request_from(client, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request(
+        {"type": "http", "client": (client, 1234), "headers": headers, "path": "/"}
+    )
+
+
+def test_forwarded_for_is_only_trusted_from_proxies(monkeypatch):
+    monkeypatch.setattr(
+        utils.rate_limit,
+        "RATE_LIMIT_TRUSTED_PROXIES",
+        [ipaddress.ip_network("10.0.0.0/8")],
+    )
+
+    # A client can't pick its own bucket by sending the header directly
+    assert client_address(request_from("203.0.113.9", "198.51.100.1")) == (
+        "203.0.113.9"
+    )
+    # Behind two trusted proxies the rightmost untrusted hop is the client,
+    # anything the client put in front of it is ignored
+    assert (
+        client_address(request_from("10.0.0.2", "1.2.3.4, 198.51.100.1, 10.0.0.1"))
+        == "198.51.100.1"
+    )
+    assert client_address(request_from("10.0.0.2")) == "10.0.0.2"
@@ -0,0 +1,108 @@
+from typing import Dict
+from utils.blocking_io import run_coordination_io
+from utils.coordination import CoordinationBackendInstance
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+logging.basicConfig(level=logging.INFO)
+
+# Events buffered per subscriber, the oldest are dropped when a client lags
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 100))
+# How often each worker picks up the events published by the other workers,
+# and how long they stay in the coordination backend for it
+EVENT_POLL_SECONDS = float(os.getenv("EVENT_POLL_SECONDS", 1))
+EVENT_TTL_SECONDS = 60
+
+
+class Subscriber:
+    def __init__(self, role) -> None:
+        self.role = role
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.dropped = 0
+
+    def push(self, event) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self) -> Dict:
+        return await self.queue.get()
+
+
+class EventBroker:
+    """Fan catalog change events out to WebSocket and SSE subscribers.
+
+    Subscribers are indexed by role and see the same files as in
+    ApiLogic.get_filenames_details: admins get every event, other roles
+    only events for their own files. An idle subscriber costs one queue.
+
+    Events reach this worker's subscribers at once and are also written to
+    the coordination backend. relay() runs in every worker and delivers the
+    events published by the others within EVENT_POLL_SECONDS.
+    """
+
+    def __init__(self, backend) -> None:
+        self.backend = backend
+        self.worker_id = uuid.uuid4().hex
+        self._subscribers = {}
+        self._sequence = 0
+        self._writes = set()
+
+    def subscribe(self, role) -> Subscriber:
+        subscriber = Subscriber(role)
+        self._subscribers.setdefault(role, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber) -> None:
+        subscribers = self._subscribers.get(subscriber.role)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+
+    @property
+    def subscriber_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def publish(self, event, role) -> None:
+        """Send the event to admins and to subscribers with the file's role"""
+        self._deliver(event, role)
+
+        self._sequence += 1
+        key = f"event:{time.time_ns()}:{self.worker_id}:{self._sequence}"
+        record = {"event": event, "role": role, "worker": self.worker_id}
+        task = asyncio.get_running_loop().create_task(
+            run_coordination_io(self.backend.set, key, record, ttl=EVENT_TTL_SECONDS)
+        )
+        # Keep a reference until written, the loop only holds weak ones
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    def _deliver(self, event, role) -> None:
+        targets = [role, "admin"] if role != "admin" else ["admin"]
+        for target in targets:
+            for subscriber in self._subscribers.get(target, ()):
+                subscriber.push(event)
+
+    async def relay(self) -> None:
+        """Deliver the events of the other workers until cancelled"""
+        delivered = None
+        while True:
+            try:
+                records = await run_coordination_io(self.backend.items, "event:")
+                if delivered is not None:
+                    for key in sorted(records.keys() - delivered):
+                        record = records[key]
+                        if record["worker"] != self.worker_id:
+                            self._deliver(record["event"], record["role"])
+                # Events from before this worker started are skipped, expired
+                # ones drop out of the set along with the backend entries
+                delivered = set(records)
+            except Exception as error:
+                logging.error(f"Could not read events of other workers: {error}")
+            await asyncio.sleep(EVENT_POLL_SECONDS)
+
+
+EventBrokerInstance = EventBroker(CoordinationBackendInstance)
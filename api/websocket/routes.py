@@ -0,0 +1,91 @@
+from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from services.routes import get_current_role
+from utils.auth_utils import verify_token_payload
+from websocket.events import EventBrokerInstance
+from typing import Optional
+import asyncio
+import json
+import logging
+import os
+
+logging.basicConfig(level=logging.INFO)
+
+# Seconds between SSE keep-alive comments so proxies keep idle streams open
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+
+router = APIRouter()
+
+
+async def resolve_role(token) -> str:
+    """Role of the access token's user, browsers pass it as ?token="""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token is required")
+
+    role = await get_current_role(verify_token_payload(token))
+    if role not in ("admin", "A", "B"):
+        raise HTTPException(status_code=401, detail="Unauthorized user")
+    return role
+
+
+async def _wait_for_disconnect(websocket: WebSocket) -> None:
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+
+
+@router.websocket("/ws/events")
+async def events_websocket(websocket: WebSocket, token: Optional[str] = None):
+    try:
+        role = await resolve_role(token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    subscriber = EventBrokerInstance.subscribe(role)
+    disconnected = asyncio.create_task(_wait_for_disconnect(websocket))
+    try:
+        while True:
+            event = asyncio.create_task(subscriber.get())
+            done, _ = await asyncio.wait(
+                {event, disconnected}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if disconnected in done:
+                event.cancel()
+                break
+            await websocket.send_json(event.result())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        EventBrokerInstance.unsubscribe(subscriber)
+        disconnected.cancel()
+
+
+@router.get("/events")
+async def events_stream(token: Optional[str] = Query(None)):
+    """Server-sent events fallback for clients that can't open a WebSocket"""
+    role = await resolve_role(token)
+    subscriber = EventBrokerInstance.subscribe(role)
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscriber.get(), SSE_KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            EventBrokerInstance.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )